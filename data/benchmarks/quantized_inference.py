@@ -0,0 +1,91 @@
+"""
+Compares eager fp32 inference against the int8 TorchScript export side by
+side: decode latency at a few batch sizes, BLEU against the held-out corpus
+references, and how often the two produce the same translation.
+
+Run from the data directory after python -m nlp.train and python -m nlp.export:
+    python -m benchmarks.quantized_inference [--sentences 500] [--repeats 5]
+"""
+from argparse import ArgumentParser
+from time import perf_counter
+
+from nltk.translate.bleu_score import SmoothingFunction, corpus_bleu
+from torch import set_num_threads
+
+import nlp.model as model
+from nlp.corpus import iter_normalized
+
+BATCH_SIZES = [1, 8, 32]
+
+
+def held_out(src_lang, tgt_lang, num_sentences):
+    """
+    :return: first num_sentences (source, reference) pairs of the corpus's
+        test rows, which training never sees
+    """
+    corpus = model.get_corpus()
+    rows = set(corpus["test"][:num_sentences].tolist())
+    src = [sentence for i, sentence in enumerate(iter_normalized(model.CORPUS_DIR, src_lang))
+           if i in rows]
+    tgt = [sentence for i, sentence in enumerate(iter_normalized(model.CORPUS_DIR, tgt_lang))
+           if i in rows]
+    return src, tgt
+
+
+def time_decode(sentences, encoder, decoder, src_lang, tgt_lang, batch_size, repeats):
+    """
+    :return: mean milliseconds per sentence, translations from the last run
+    """
+    best = None
+    for _ in range(repeats):
+        start = perf_counter()
+        translations = []
+        for i in range(0, len(sentences), batch_size):
+            translations += model.decode_batch(
+                sentences[i:i + batch_size], encoder, decoder, src_lang, tgt_lang)
+        elapsed = perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best / len(sentences) * 1000, translations
+
+
+def main():
+    parser = ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--src", default=model.SRC_LANG)
+    parser.add_argument("--tgt", default=model.TGT_LANG)
+    parser.add_argument("--sentences", type=int, default=500)
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--threads", type=int, default=1)
+    args = parser.parse_args()
+
+    set_num_threads(args.threads)
+    model.load_tokenizers()
+    src, references = held_out(args.src, args.tgt, args.sentences)
+    references = [[reference.split(" ")] for reference in references]
+
+    results = {}
+    for mode in ["eager", "optimized"]:
+        model.load_models(mode=mode)
+        encoder, decoder = model.get_translator(args.src, args.tgt)
+        results[mode] = {
+            batch_size: time_decode(src, encoder, decoder, args.src, args.tgt,
+                                    batch_size, args.repeats)
+            for batch_size in BATCH_SIZES
+        }
+
+    smoothing = SmoothingFunction().method1
+    print(f"{args.src}->{args.tgt}, {len(src)} held-out sentences, {args.threads} thread(s)")
+    print(f"{'mode':>10} " + " ".join(f"{f'ms/sent b={b}':>14}" for b in BATCH_SIZES) + f" {'BLEU':>8}")
+    for mode, by_batch in results.items():
+        translations = by_batch[BATCH_SIZES[-1]][1]
+        bleu = corpus_bleu(references, translations, smoothing_function=smoothing)
+        print(f"{mode:>10} " + " ".join(f"{by_batch[b][0]:>14.3f}" for b in BATCH_SIZES)
+              + f" {bleu * 100:>8.2f}")
+
+    eager = results["eager"][BATCH_SIZES[-1]][1]
+    optimized = results["optimized"][BATCH_SIZES[-1]][1]
+    same = sum(a == b for a, b in zip(eager, optimized))
+    print(f"identical translations: {same}/{len(eager)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+"""
+Scaling report for multi-process training: wall-clock throughput of
+training both directions sequentially in one process, against training
+them in parallel with 1, 2, 4... data-parallel processes per direction.
+
+Run from the data directory:
+    python -m benchmarks.training_scaling [--processes 1 2 4] [--epochs 1] [--threads 1]
+"""
+from argparse import ArgumentParser
+from time import perf_counter
+
+from torch import set_num_threads
+
+import nlp.model as model
+from nlp.parallel import train_models_parallel
+
+
+def main():
+    parser = ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--processes", type=int, nargs="+", default=[1, 2, 4],
+                        help="data-parallel processes per direction")
+    parser.add_argument("--epochs", type=int, default=1)
+    parser.add_argument("--batch-size", type=int, default=model.TRAIN_BATCH_SIZE)
+    parser.add_argument("--threads", type=int, default=1,
+                        help="torch threads per process")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    model.load_tokenizers()
+    corpus = model.get_corpus()
+    train, _ = model.get_train_test(corpus)
+    # both directions see every training sentence each epoch
+    sentences = 2 * len(train) * args.epochs
+    kwargs = {"epochs": args.epochs, "batch_size": args.batch_size}
+
+    set_num_threads(args.threads)
+    start = perf_counter()
+    model.train_models(**kwargs)
+    baseline = sentences / (perf_counter() - start)
+
+    results = []
+    for processes in args.processes:
+        start = perf_counter()
+        train_models_parallel(processes, args.threads, args.seed, **kwargs)
+        results.append((processes, sentences / (perf_counter() - start)))
+
+    print(f"{sentences} sentences, {args.threads} thread(s) per process")
+    print(f"{'mode':>22} {'processes':>10} {'sentences/s':>12} {'speedup':>8} {'efficiency':>10}")
+    print(f"{'sequential':>22} {1:>10} {baseline:>12.1f} {1:>8.2f} {1:>10.2f}")
+    for processes, rate in results:
+        total = 2 * processes
+        speedup = rate / baseline
+        print(f"{f'parallel, {processes}/direction':>22} {total:>10} {rate:>12.1f} "
+              f"{speedup:>8.2f} {speedup / total:>10.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+"""
+Times translate_batch on corpus sentences with and without the translation
+memory, plus the raw memory lookup, and reports how many sentences hit.
+
+Run from the data directory after python -m nlp.train:
+    python -m benchmarks.translation_memory [--sentences 500] [--batch-size 32]
+"""
+from argparse import ArgumentParser
+from random import sample, seed
+from time import perf_counter
+
+from torch import set_num_threads
+
+import nlp.model as model
+
+
+def time_translate(sentences, encoder, decoder, src_lang, tgt_lang, batch_size):
+    """
+    :return: mean milliseconds per sentence
+    """
+    model.translation_cache.clear()
+    start = perf_counter()
+    for i in range(0, len(sentences), batch_size):
+        model.translate_batch(sentences[i:i + batch_size], encoder, decoder,
+                              src_lang, tgt_lang)
+    return (perf_counter() - start) / len(sentences) * 1000
+
+
+def main():
+    parser = ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--src", default=model.SRC_LANG)
+    parser.add_argument("--tgt", default=model.TGT_LANG)
+    parser.add_argument("--sentences", type=int, default=500)
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--threads", type=int, default=1)
+    args = parser.parse_args()
+
+    set_num_threads(args.threads)
+    model.load_tokenizers()
+    model.get_corpus()
+    if not model.load_models():
+        raise SystemExit(f"no model artifact in {model.ARTIFACT_DIR}, run python -m nlp.train")
+    if not model.load_translation_memory():
+        raise SystemExit("no translation memory, is TRANSLATION_MEMORY=0 set?")
+    memory = model.translation_memory
+    encoder, decoder = model.get_translator(args.src, args.tgt)
+
+    seed(0)
+    texts = memory.text[args.src]
+    rows = sample(range(len(texts)), min(args.sentences, len(texts)))
+    sentences = [texts[row] for row in rows]
+    normalized = model.normalize_batch(sentences, args.src)
+
+    start = perf_counter()
+    hits = sum(memory.lookup(norm_msg, args.src, args.tgt) is not None
+               for norm_msg in normalized)
+    lookup_us = (perf_counter() - start) / len(normalized) * 1e6
+
+    with_memory = time_translate(sentences, encoder, decoder, args.src, args.tgt,
+                                 args.batch_size)
+    model.translation_memory = None
+    without_memory = time_translate(sentences, encoder, decoder, args.src, args.tgt,
+                                    args.batch_size)
+    model.translation_memory = memory
+
+    print(f"{args.src}->{args.tgt}, {len(sentences)} corpus sentences, "
+          f"batch size {args.batch_size}, {args.threads} thread(s)")
+    print(f"memory hits: {hits}/{len(sentences)}, {lookup_us:.1f}us per lookup")
+    print(f"{'decoder only':>16} {without_memory:>8.3f} ms/sent")
+    print(f"{'with memory':>16} {with_memory:>8.3f} ms/sent")
+
+
+if __name__ == "__main__":
+    main()
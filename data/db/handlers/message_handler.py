@@ -1,7 +1,18 @@
+from base64 import urlsafe_b64decode, urlsafe_b64encode
 from datetime import datetime
+from uuid import UUID, uuid4
 
-from db.models import Message
+from sqlalchemy import and_, func, insert, or_, tuple_
+
+import db.handlers.translation_handler as translation_handler
+import db.handlers.user_handler as user_handler
+from db.models import (TRANSLATION_PENDING, Message, Translation, User,
+                       get_datettime, pair_high, pair_low)
 from db.sqlalchemy_db import create_session
+from nlp.jobs import enqueue_translation, submit_translations
+
+# messages per translation job when a bulk insert queues translations
+TRANSLATION_JOB_SIZE = 64
 
 
 def get_message_by_id(id: str, serialize=True):
@@ -19,24 +30,145 @@ def get_message_by_id(id: str, serialize=True):
         return message
 
 
+def conversation_filter(user_1: str, user_2: str):
+    """
+    Filter matching messages in either direction between two users.
+    Written against the unordered pair so it hits ix_message_pair_sent_at.
+    """
+    low, high = sorted([UUID(str(user_1)), UUID(str(user_2))])
+    return and_(
+        pair_low(Message.sender, Message.receiver) == low,
+        pair_high(Message.sender, Message.receiver) == high,
+    )
+
+
+def encode_cursor(message: dict):
+    """
+    Encode a serialized message's (sent_at, id) position as an opaque cursor.
+    :param message: JSON
+    :return: URL-safe string
+    """
+    position = f"{message['sent_at'].isoformat()},{message['id']}"
+    return urlsafe_b64encode(position.encode()).decode()
+
+
+def decode_cursor(cursor: str):
+    """
+    Decode a cursor from encode_cursor.
+    :param cursor: URL-safe string
+    :return: (sent_at, id) or raise ValueError if malformed
+    """
+    try:
+        sent_at, id = urlsafe_b64decode(cursor.encode()).decode().split(",")
+        return datetime.fromisoformat(sent_at), UUID(id)
+    except Exception:
+        raise ValueError(f"Invalid cursor '{cursor}'")
+
+
+def cursor_position(cursor: str):
+    """
+    Typed (sent_at, id) row value of a cursor, comparable to Message columns.
+    """
+    return tuple_(*decode_cursor(cursor),
+                  types=[Message.sent_at.type, Message.id.type])
+
+
 def get_conversation(user_1: str, user_2: str, serialize: bool = True):
     """
-    Get message list by sender and receiver.
-    :param sender: UUID
-    :param receiver: UUID
+    Get every message between two users, oldest first.
+    :param user_1: UUID
+    :param user_2: UUID
     :return: JSON
     """
     with create_session() as session:
-        messages = session.query(Message).filter(
-            Message.sender == user_1 and Message.receiver == user_2).all()
-        messages += session.query(Message).filter(
-            Message.sender == user_2 and Message.receiver == user_1).all()
-
-        if messages == None:
-            return None
+        messages = session.query(Message) \
+            .filter(conversation_filter(user_1, user_2)) \
+            .order_by(Message.sent_at, Message.id).all()
         return [message.serialize if serialize else message for message in messages]
 
 
+def get_conversation_page(user_1: str, user_2: str, limit: int,
+                          before: str = None, after: str = None):
+    """
+    Get one page of messages between two users, oldest first.
+    Without a cursor returns the latest page. Pages are keyed on
+    (sent_at, id) so messages sharing a timestamp are never skipped.
+    :param user_1: UUID
+    :param user_2: UUID
+    :param limit: max messages in the page
+    :param before: cursor, only return messages older than it
+    :param after: cursor, only return messages newer than it
+    :return: JSON {"messages", "has_more", "before", "after"}
+    """
+    position = tuple_(Message.sent_at, Message.id)
+    with create_session() as session:
+        query = session.query(Message).filter(
+            conversation_filter(user_1, user_2))
+        if before:
+            query = query.filter(position < cursor_position(before))
+        if after:
+            query = query.filter(position > cursor_position(after))
+
+        forward = after and not before
+        if forward:
+            query = query.order_by(Message.sent_at, Message.id)
+        else:
+            query = query.order_by(
+                Message.sent_at.desc(), Message.id.desc())
+
+        # fetch one extra row to know whether another page exists
+        messages = [message.serialize for message in query.limit(limit + 1).all()]
+
+    has_more = len(messages) > limit
+    messages = messages[:limit]
+    if not forward:
+        messages.reverse()
+
+    return {
+        "messages": messages,
+        "has_more": has_more,
+        "before": encode_cursor(messages[0]) if messages else before,
+        "after": encode_cursor(messages[-1]) if messages else after,
+    }
+
+
+def get_last_message(user_1: str, user_2: str):
+    """
+    Get the latest message between two users.
+    :param user_1: UUID
+    :param user_2: UUID
+    :return: JSON or None if they have no messages
+    """
+    with create_session() as session:
+        message = session.query(Message) \
+            .filter(conversation_filter(user_1, user_2)) \
+            .order_by(Message.sent_at.desc(), Message.id.desc()) \
+            .limit(1).first()
+        return message.serialize if message else None
+
+
+def get_last_messages(user_id: str):
+    """
+    Get the latest message of every conversation a user is in, newest first.
+    :param user_id: UUID
+    :return: JSON list
+    """
+    with create_session() as session:
+        rank = func.row_number().over(
+            partition_by=(pair_low(Message.sender, Message.receiver),
+                          pair_high(Message.sender, Message.receiver)),
+            order_by=(Message.sent_at.desc(), Message.id.desc()),
+        ).label("rank")
+        ranked = session.query(Message.id, rank) \
+            .filter(or_(Message.sender == user_id, Message.receiver == user_id)) \
+            .subquery()
+        messages = session.query(Message) \
+            .join(ranked, Message.id == ranked.c.id) \
+            .filter(ranked.c.rank == 1) \
+            .order_by(Message.sent_at.desc(), Message.id.desc()).all()
+        return [message.serialize for message in messages]
+
+
 def get_all_messages():
     """
     Get all messages
@@ -49,21 +181,123 @@ def get_all_messages():
 
 def create_message(sender: str, receiver: str, sent_at: datetime, message_content: str, lang: str, serialize: bool = True):
     """
-    Create a new message based on an associated name
-    :param name: ex. "AJ Wong"
-    :return: JSON (new stock) or raise RuntimeError if already exists
+    Create a new message and queue its translation into the receiver's language
+    :param sender: UUID
+    :param receiver: UUID
+    :param sent_at: datetime
+    :param message_content: original text
+    :param lang: language of message_content
+    :return: JSON (new message)
     """
     with create_session() as session:
         try:
             message = Message(sender=sender, receiver=receiver,
                               sent_at=sent_at, message_content=message_content, lang=lang)
             session.add(message)
+            session.flush()
+            message_id = message.id
+
+            receiver_user = session.get(User, receiver)
+            tgt_lang = receiver_user.lang if receiver_user else None
+            if tgt_lang and tgt_lang != lang:
+                translation_handler.create_pending_translation(
+                    session, message.id, tgt_lang)
+
             # must commit before new message can be fetched from DB table
             session.commit()
-            return message.serialize if serialize else message
+            result = message.serialize if serialize else message
         except Exception as e:
             raise e
 
+    if tgt_lang and tgt_lang != lang:
+        enqueue_translation(message_id, message_content, lang, tgt_lang)
+    return result
+
+
+def validate_message(message: dict, default_sent_at: datetime):
+    """
+    Check one message of a bulk insert and convert it to a row.
+    :param message: JSON with sender, receiver, content, lang and an
+        optional ISO sent_at
+    :param default_sent_at: sent_at for messages without one
+    :return: row dict or raise ValueError if invalid
+    """
+    if not isinstance(message, dict):
+        raise ValueError("must be an object")
+    for key in ["sender", "receiver", "content", "lang"]:
+        if message.get(key) is None:
+            raise ValueError(f"missing '{key}'")
+    if not isinstance(message["content"], str):
+        raise ValueError("'content' must be a string")
+    try:
+        sender, receiver = UUID(str(message["sender"])), UUID(str(message["receiver"]))
+    except ValueError:
+        raise ValueError("'sender' and 'receiver' must be UUIDs")
+    try:
+        sent_at = datetime.fromisoformat(message["sent_at"]) \
+            if message.get("sent_at") else default_sent_at
+    except (TypeError, ValueError):
+        raise ValueError("'sent_at' must be an ISO 8601 timestamp")
+
+    return {
+        "id": uuid4(),
+        "sender": sender,
+        "receiver": receiver,
+        "sent_at": sent_at,
+        "message_content": message["content"],
+        "lang": message["lang"],
+    }
+
+
+def create_messages(messages: "list[dict]"):
+    """
+    Validate and insert many messages in one transaction, queueing
+    translations for receivers that read another language.
+    Ids are generated here so the rows go out as a single executemany
+    instead of one INSERT ... RETURNING per message.
+    :param messages: list of JSON with sender, receiver, content, lang and
+        an optional ISO sent_at, defaulting to now
+    :return: list of new message UUIDs in input order or raise ValueError
+        naming the first invalid message
+    """
+    now = get_datettime()
+    rows = []
+    for i, message in enumerate(messages):
+        try:
+            rows.append(validate_message(message, now))
+        except ValueError as e:
+            raise ValueError(f"message {i}: {e}")
+    if not rows:
+        return []
+
+    receivers = user_handler.get_users_by_ids({row["receiver"] for row in rows})
+    pending = {}
+    for row in rows:
+        receiver = receivers.get(str(row["receiver"]))
+        tgt_lang = receiver["lang"] if receiver else None
+        if tgt_lang and tgt_lang != row["lang"]:
+            pending.setdefault((row["lang"], tgt_lang), []).append(row)
+
+    with create_session() as session:
+        session.execute(insert(Message), rows)
+        translations = [
+            {"id": uuid4(), "message_id": row["id"], "lang": tgt_lang,
+             "status": TRANSLATION_PENDING, "created_at": now}
+            for (_, tgt_lang), group in pending.items() for row in group
+        ]
+        if translations:
+            session.execute(insert(Translation), translations)
+        # translation workers read the rows, so commit before queueing
+        session.commit()
+
+    for (src_lang, tgt_lang), group in pending.items():
+        for i in range(0, len(group), TRANSLATION_JOB_SIZE):
+            chunk = group[i:i + TRANSLATION_JOB_SIZE]
+            submit_translations([row["id"] for row in chunk],
+                                [row["message_content"] for row in chunk],
+                                src_lang, tgt_lang)
+    return [row["id"] for row in rows]
+
 
 def delete_message_by_id(id: str):
     """
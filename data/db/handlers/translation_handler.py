@@ -0,0 +1,75 @@
+from db.models import TRANSLATION_DONE, TRANSLATION_PENDING, Translation, get_datettime
+from db.sqlalchemy_db import create_session
+
+
+def get_translations(message_ids: "list[str]", lang: str, serialize: bool = True):
+    """
+    Get stored translations of many messages into one language.
+    :param message_ids: list of message UUIDs
+    :param lang: language of the translations
+    :return: dict of message_id -> JSON
+    """
+    if not message_ids:
+        return {}
+
+    with create_session() as session:
+        translations = session.query(Translation).filter(
+            Translation.message_id.in_(message_ids),
+            Translation.lang == lang).all()
+        return {
+            translation.message_id: translation.serialize if serialize else translation
+            for translation in translations
+        }
+
+
+def create_pending_translation(session, message_id: str, lang: str):
+    """
+    Add a pending translation row to an open session, so it commits in the
+    same transaction as its message.
+    :param session: active session
+    :param message_id: UUID
+    :param lang: language to translate into
+    :return: Translation
+    """
+    translation = Translation(
+        message_id=message_id, lang=lang, status=TRANSLATION_PENDING)
+    session.add(translation)
+    return translation
+
+
+def save_translations(translations: "list[tuple]", lang: str):
+    """
+    Store finished translations, filling in pending rows or adding missing ones.
+    :param translations: list of (message_id, translated_content)
+    :param lang: language of the translations
+    """
+    if not translations:
+        return
+
+    with create_session() as session:
+        message_ids = [message_id for message_id, _ in translations]
+        existing = {
+            translation.message_id: translation
+            for translation in session.query(Translation).filter(
+                Translation.message_id.in_(message_ids),
+                Translation.lang == lang).all()
+        }
+        translated_at = get_datettime()
+        for message_id, content in translations:
+            translation = existing.get(message_id)
+            if translation is None:
+                translation = Translation(message_id=message_id, lang=lang)
+                session.add(translation)
+            translation.translated_content = content
+            translation.status = TRANSLATION_DONE
+            translation.translated_at = translated_at
+
+
+def save_translation(message_id: str, lang: str, content: str):
+    """
+    Store a single finished translation.
+    :param message_id: UUID
+    :param lang: language of the translation
+    :param content: translated text
+    """
+    save_translations([(message_id, content)], lang)
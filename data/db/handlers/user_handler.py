@@ -1,31 +1,97 @@
+from os import getenv
+from uuid import UUID
+
+from cache import LRUCache
 from db.models import User
 from db.sqlalchemy_db import create_session
 
+USER_CACHE_SIZE = int(getenv("USER_CACHE_SIZE") or 10000)
+USER_CACHE_TTL = float(getenv("USER_CACHE_TTL") or 300)
+
+# serialized users keyed by ("id", id) and ("name", name). Each server
+# process has its own, so writes elsewhere show up after at most the TTL
+user_cache = LRUCache(USER_CACHE_SIZE, USER_CACHE_TTL)
+
+
+def cache_user(user: dict):
+    user_cache.set(("id", str(user["id"])), user)
+    user_cache.set(("name", user["name"]), user)
+
+
+def invalidate_user(user: dict):
+    """
+    Drop a user from the cache under every key it's stored under
+    :param user: JSON as last cached or read from the DB
+    """
+    user_cache.delete(("id", str(user["id"])))
+    user_cache.delete(("name", user["name"]))
+
 
 def get_user_by_id(id: str, serialize=True):
     """
-    Get user by primary key
+    Get user by primary key, serialized users come from the user cache
     :param id: UUID
     :return: JSON
     """
+    if serialize:
+        user = user_cache.get(("id", str(id)))
+        if user is not None:
+            return dict(user)
+
     with create_session() as session:
         user = session.get(User, id)
         if user == None:
             return None
         elif serialize:
             user = user.serialize
+            cache_user(user)
+            user = dict(user)
         return user
 
 
+def get_users_by_ids(ids: "list[str]"):
+    """
+    Get many users, fetching the ones missing from the cache in one query
+    :param ids: list of UUIDs, in any form UUID() accepts
+    :return: dict of canonical str(UUID(id)) -> JSON, users that don't exist
+    are left out, or raise ValueError if an id isn't a UUID
+    """
+    users = {}
+    misses = []
+    # canonical, so cache keys match str(user["id"]) of the DB rows
+    for id in {UUID(str(id)) for id in ids}:
+        user = user_cache.get(("id", str(id)))
+        if user is not None:
+            users[str(id)] = dict(user)
+        else:
+            misses.append(id)
+
+    if misses:
+        with create_session() as session:
+            for user in session.query(User).filter(User.id.in_(misses)).all():
+                user = user.serialize
+                cache_user(user)
+                users[str(user["id"])] = dict(user)
+    return users
+
+
 def get_user_by_name(name: str):
     """
     Get user by name.
     :param name: ex. "AJ Wong"
     :return: JSON or raise RuntimeException if not found
     """
+    user = user_cache.get(("name", name))
+    if user is not None:
+        return dict(user)
+
     with create_session() as session:
         user = session.query(User).filter(User.name == name).first()
-        return user.serialize if user else None
+        if user == None:
+            return None
+        user = user.serialize
+        cache_user(user)
+        return dict(user)
 
 
 def get_all_users():
@@ -45,14 +111,37 @@ def create_user(name: str):
     :return: JSON (new stock) or raise RuntimeError if already exists
     """
     with create_session() as session:
-        try:
-            user = User(name=name)
-            session.add(user)
-            # must commit before new user can be fetched from DB table
-            session.commit()
-            return get_user_by_name(name=name)
-        except Exception as e:
-            raise e
+        user = User(name=name)
+        session.add(user)
+        # flush fills in the generated id, create_session commits on exit
+        session.flush()
+        return user.serialize
+
+
+def update_user(id: str, name: str = None, lang: str = None):
+    """
+    Update a user's name and/or language and drop it from the user cache
+    :param id: UUID
+    :param name: new name, unchanged if None
+    :param lang: new language code, unchanged if None
+    :return: JSON (updated user) or raise RuntimeError if not found
+    """
+    with create_session() as session:
+        user = get_user_by_id(id=id, serialize=False)
+        if not user:
+            raise RuntimeError(f"Cannot update nonexistent user with ID {id}")
+        old = user.serialize
+        if name is not None:
+            user.name = name
+        if lang is not None:
+            user.lang = lang
+        session.flush()
+        updated = user.serialize
+
+    # after commit, so a concurrent read can't re-cache the old row
+    invalidate_user(old)
+    invalidate_user(updated)
+    return updated
 
 
 def delete_user_by_id(id: str):
@@ -64,5 +153,7 @@ def delete_user_by_id(id: str):
         user = get_user_by_id(id=id, serialize=False)
         if not user:
             raise RuntimeError(f"Cannot delete nonexistent user with ID {id}")
+        old = user.serialize
         session.delete(user)
         session.commit()
+    invalidate_user(old)
@@ -2,13 +2,16 @@
 from datetime import datetime
 from uuid import uuid4
 
-from sqlalchemy import Column, DateTime, ForeignKey, Integer, String
+from sqlalchemy import (Column, DateTime, ForeignKey, Index, Integer, String,
+                        UniqueConstraint)
 from sqlalchemy.dialects.postgresql import UUID
+from sqlalchemy.ext.compiler import compiles
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import validates
+from sqlalchemy.sql.functions import GenericFunction
 from sqlalchemy.sql.sqltypes import Text
 
-from db.sqlalchemy_db import create_table, get_engine
+from db.sqlalchemy_db import create_indexes, create_table, get_engine
 
 Base = declarative_base()
 
@@ -42,6 +45,43 @@ def get_datettime():
     return datetime.now()
 
 
+class pair_low(GenericFunction):
+    """
+    Smaller of two user ids, so (pair_low, pair_high) names an unordered pair.
+    LEAST on postgres, MIN on sqlite.
+    """
+    type = UUID(as_uuid=True)
+    inherit_cache = True
+
+
+class pair_high(GenericFunction):
+    """
+    Larger of two user ids. GREATEST on postgres, MAX on sqlite.
+    """
+    type = UUID(as_uuid=True)
+    inherit_cache = True
+
+
+@compiles(pair_low)
+def compile_pair_low(element, compiler, **kw):
+    return f"least({compiler.process(element.clauses, **kw)})"
+
+
+@compiles(pair_low, "sqlite")
+def compile_pair_low_sqlite(element, compiler, **kw):
+    return f"min({compiler.process(element.clauses, **kw)})"
+
+
+@compiles(pair_high)
+def compile_pair_high(element, compiler, **kw):
+    return f"greatest({compiler.process(element.clauses, **kw)})"
+
+
+@compiles(pair_high, "sqlite")
+def compile_pair_high_sqlite(element, compiler, **kw):
+    return f"max({compiler.process(element.clauses, **kw)})"
+
+
 class User(Base):
     __tablename__ = "user"
 
@@ -88,10 +128,55 @@ class Message(Base):
         }
 
 
+# directed lookups, e.g. everything one user sent or received
+Index("ix_message_sender_receiver_sent_at",
+      Message.sender, Message.receiver, Message.sent_at, Message.id)
+Index("ix_message_receiver_sender_sent_at",
+      Message.receiver, Message.sender, Message.sent_at, Message.id)
+# conversation lookups: both directions of a pair in one ordered range scan
+Index("ix_message_pair_sent_at",
+      pair_low(Message.sender, Message.receiver),
+      pair_high(Message.sender, Message.receiver),
+      Message.sent_at, Message.id)
+
+
+TRANSLATION_PENDING = "pending"
+TRANSLATION_DONE = "done"
+
+
+class Translation(Base):
+    __tablename__ = "translation"
+    __table_args__ = (UniqueConstraint("message_id", "lang"),)
+
+    id = p_key_column()
+    message_id = f_key_column("message.id")
+    lang = Column(String)
+    translated_content = Column(String, nullable=True)
+    status = Column(String, default=TRANSLATION_PENDING)
+    created_at = Column(DateTime, default=get_datettime)
+    translated_at = Column(DateTime, nullable=True)
+
+    @property
+    def serialize(self):
+        """
+        Return JSON serialized version of Translation instance
+        @return: JSON
+        """
+        return {
+            "id": self.id,
+            "message_id": self.message_id,
+            "lang": self.lang,
+            "translated_content": self.translated_content,
+            "status": self.status,
+            "translated_at": self.translated_at
+        }
+
+
 def instantiate_tables():
     """
     Define all tables, should be called only once
     """
     print("instantiating db tables...")
-    for table in [User, Message]:
+    for table in [User, Message, Translation]:
         create_table(table)
+        create_indexes(table)
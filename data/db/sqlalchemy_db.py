@@ -1,14 +1,77 @@
 from contextlib import contextmanager
 from os import getenv
-from time import sleep
+from threading import Lock, local
+from time import perf_counter, sleep
 
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import Session as BaseSession
+from sqlalchemy.orm import scoped_session, sessionmaker
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.schema import CreateIndex
+
+DB_POOL_SIZE = int(getenv("DB_POOL_SIZE") or 5)
+DB_MAX_OVERFLOW = int(getenv("DB_MAX_OVERFLOW") or 10)
+DB_POOL_TIMEOUT = float(getenv("DB_POOL_TIMEOUT") or 30)
+# test connections on checkout so ones dropped by the server are replaced
+DB_POOL_PRE_PING = (getenv("DB_POOL_PRE_PING") or "1") != "0"
+# seconds before a pooled connection is replaced, -1 to keep forever
+DB_POOL_RECYCLE = int(getenv("DB_POOL_RECYCLE") or 1800)
+# first connect retries with exponential backoff while the DB starts up
+DB_CONNECT_RETRIES = int(getenv("DB_CONNECT_RETRIES") or 8)
+DB_CONNECT_BACKOFF = float(getenv("DB_CONNECT_BACKOFF") or 0.5)
+DB_CONNECT_MAX_BACKOFF = float(getenv("DB_CONNECT_MAX_BACKOFF") or 10)
 
 # init in init_db_connection
 engine = None
+# thread-local registry, so every create_session in a thread shares one session
 Session = None
 
+# per thread: create_session nesting depth and whether a request scope is open
+_scope = local()
+
+_pool_stats_lock = Lock()
+_pool_stats = {
+    "connects": 0,
+    "checkouts": 0,
+    "checkins": 0,
+    "waits": 0,
+    "wait_time": 0.0,
+    "max_wait": 0.0,
+    "timeouts": 0,
+}
+
+
+class MeteredQueuePool(QueuePool):
+    """
+    QueuePool that records how often and how long callers wait for a
+    connection because the pool is at capacity. Checkouts that get an idle
+    connection or open a new one within max_overflow aren't waits
+    """
+
+    def at_capacity(self):
+        return self._max_overflow >= 0 \
+            and self.checkedout() >= self.size() + self._max_overflow
+
+    def _do_get(self):
+        if self.checkedin() > 0 or not self.at_capacity():
+            return super()._do_get()
+
+        start = perf_counter()
+        try:
+            return super()._do_get()
+        except Exception:
+            with _pool_stats_lock:
+                _pool_stats["timeouts"] += 1
+            raise
+        finally:
+            waited = perf_counter() - start
+            with _pool_stats_lock:
+                _pool_stats["waits"] += 1
+                _pool_stats["wait_time"] += waited
+                _pool_stats["max_wait"] = max(_pool_stats["max_wait"], waited)
+
 
 def generate_db_uri(
     driver: str = "postgresql",
@@ -47,29 +110,107 @@ def generate_db_uri(
     return f"{driver}://{user}:{password}@{host}:{port}/{db}"
 
 
-def init_db_connection():
+def pool_options(uri: str):
+    """
+    Engine pool settings from env variables
+    @param uri: database URI
+    @return: create_engine keyword arguments
+    """
+    options = {
+        "pool_pre_ping": DB_POOL_PRE_PING,
+        "pool_recycle": DB_POOL_RECYCLE,
+    }
+    url = make_url(uri)
+    if url.get_backend_name() == "sqlite" and url.database in (None, "", ":memory:"):
+        # one shared in-memory connection, nothing to size
+        return options
+    options.update({
+        "poolclass": MeteredQueuePool,
+        "pool_size": DB_POOL_SIZE,
+        "max_overflow": DB_MAX_OVERFLOW,
+        "pool_timeout": DB_POOL_TIMEOUT,
+    })
+    return options
+
+
+def count_pool_event(name: str):
+    def listener(*args):
+        with _pool_stats_lock:
+            _pool_stats[name] += 1
+    return listener
+
+
+def init_db_connection(uri: str = None):
     """
     Instantiates a singleton DB engine
+    @param uri: explicit database URI, defaults to one built from env variables
     """
     print("connecting to database...")
 
     global engine, Session
     if engine != None:
         return
-    uri = generate_db_uri()
-    sleep(10)    # wait for postgres container to launch
-    engine = create_engine(uri)
-    engine.connect()
-    Session = sessionmaker(bind=engine)
+    if uri == None:
+        uri = generate_db_uri()
+    new_engine = create_engine(uri, **pool_options(uri))
+    event.listen(new_engine, "connect", count_pool_event("connects"))
+    event.listen(new_engine, "checkout", count_pool_event("checkouts"))
+    event.listen(new_engine, "checkin", count_pool_event("checkins"))
+    wait_for_connection(new_engine)
+    engine = new_engine
+    Session = scoped_session(sessionmaker(bind=engine))
+
+
+def wait_for_connection(engine, retries: int = DB_CONNECT_RETRIES,
+                        backoff: float = DB_CONNECT_BACKOFF):
+    """
+    Connect once, retrying with exponential backoff while the database
+    isn't accepting connections yet, e.g. while its container starts
+    @param engine: engine to connect with
+    @param retries: retries before giving up
+    @param backoff: seconds before the first retry, doubled for each one
+    """
+    for attempt in range(retries + 1):
+        try:
+            engine.connect().close()
+            return
+        except OperationalError as e:
+            if attempt == retries:
+                raise e
+            print(f"database not ready ({attempt + 1}/{retries}), retrying in {backoff:.1f}s...")
+            sleep(backoff)
+            backoff = min(backoff * 2, DB_CONNECT_MAX_BACKOFF)
+
+
+def has_writes(session):
+    return bool(session.new or session.dirty or session.deleted
+                or session.info.get("flushed"))
+
+
+@event.listens_for(BaseSession, "after_flush")
+def mark_flushed(session, flush_context):
+    session.info["flushed"] = True
+
+
+@event.listens_for(BaseSession, "after_commit")
+@event.listens_for(BaseSession, "after_rollback")
+def clear_flushed(session):
+    session.info.pop("flushed", None)
 
 
 @contextmanager
 def create_session():
     """
-    Creates and returns a session
+    Returns this thread's session
     Uses contextlib's contextmanager decorator to allow for generator syntax:
     with create_session() as session:
         ...etc.
+
+    Nested calls share the outer session and only the outermost block
+    commits or rolls back. Inside a request scope the session stays open
+    across handler calls until close_request_scope, and read-only blocks
+    don't commit, so a request runs on a single pooled connection. Call
+    end_transaction before waiting on anything slow.
     @return: active session
     """
     global Session
@@ -81,14 +222,88 @@ def create_session():
         """
         )
     session = Session()
+    depth = getattr(_scope, "depth", 0)
+    _scope.depth = depth + 1
     try:
         yield session
-        session.commit()
+        if depth == 0 and (has_writes(session) or not in_request_scope()):
+            session.commit()
     except Exception as e:
-        session.rollback()
+        if depth == 0:
+            session.rollback()
         raise e
     finally:
-        session.close()
+        _scope.depth = depth
+        if depth == 0 and not in_request_scope():
+            Session.remove()
+
+
+def in_request_scope():
+    return getattr(_scope, "request", False)
+
+
+def open_request_scope():
+    """
+    Share one session between every create_session call in this thread
+    until close_request_scope
+    """
+    _scope.request = True
+
+
+def end_transaction():
+    """
+    End this thread's open transaction, returning its connection to the
+    pool, so a request doesn't hold one while it waits on something else.
+    The request's session is reused and checks out a connection again on
+    its next query
+    """
+    if Session != None and Session.registry.has() and getattr(_scope, "depth", 0) == 0:
+        Session().commit()
+
+
+def close_request_scope(exception=None):
+    """
+    Close the request's session, returning its connection to the pool
+    @param exception: unused, passed by Flask teardown
+    """
+    _scope.request = False
+    _scope.depth = 0
+    if Session != None:
+        Session.remove()
+
+
+def db_ready():
+    """
+    Whether the database is connected and answering
+    @return: bool
+    """
+    if engine == None:
+        return False
+    try:
+        with engine.connect() as connection:
+            connection.execute(text("SELECT 1"))
+        return True
+    except Exception:
+        return False
+
+
+def get_pool_stats():
+    """
+    Connection pool counters for this process
+    @return: JSON
+    """
+    with _pool_stats_lock:
+        stats = dict(_pool_stats)
+    stats["mean_wait_ms"] = stats["wait_time"] / stats["waits"] * 1000 \
+        if stats["waits"] else 0.0
+    stats["wait_time"] = round(stats["wait_time"], 6)
+    if isinstance(getattr(engine, "pool", None), QueuePool):
+        stats.update({
+            "size": engine.pool.size(),
+            "checked_out": engine.pool.checkedout(),
+            "overflow": engine.pool.overflow(),
+        })
+    return stats
 
 
 def create_table(table):
@@ -107,6 +322,37 @@ def create_table(table):
     table.__table__.create(bind=engine, checkfirst=True)
 
 
+def create_indexes(table):
+    """
+    Create any of a table's declared indexes that don't exist yet, so indexes
+    added after the table was first created get built too
+    @param table: table which inherits from Base
+    """
+    global engine
+    if engine == None:
+        raise RuntimeError(
+            """
+        DB engine is None. 
+        Please run init_db_connection() before defining tables
+        """
+        )
+    with engine.begin() as connection:
+        for index in table.__table__.indexes:
+            # IF NOT EXISTS since reflection can't see expression indexes
+            connection.execute(CreateIndex(index, if_not_exists=True))
+
+
+def dispose_after_fork():
+    """
+    Drop pooled connections inherited from a parent process without closing
+    them, so a forked server worker opens its own instead of sharing sockets
+    with the parent
+    """
+    global engine
+    if engine != None:
+        engine.dispose(close=False)
+
+
 def get_engine():
     """
     Get raw engine object. Should not be used unless explicitly needed.
@@ -1,49 +1,146 @@
+from _thread import interrupt_main
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from os import getenv
+from gc import freeze
+from multiprocessing import cpu_count
+from os import getenv, getpid, kill
+from signal import SIGHUP, SIGTERM
+from threading import Event, Thread
+from traceback import print_exc
+from uuid import UUID
 
 from flask import Flask, request
+from gunicorn.app.base import BaseApplication
+from torch import set_num_threads
 
 import db.handlers.message_handler as message_handler
 import db.handlers.user_handler as user_handler
 from db.models import instantiate_tables
-from db.sqlalchemy_db import init_db_connection
-from nlp.model import init_model
-from nlp.translate import translate_conversation
+from db.sqlalchemy_db import (close_request_scope, db_ready,
+                              dispose_after_fork, get_pool_stats,
+                              init_db_connection, open_request_scope)
+from nlp.jobs import get_translation_stats, split_pool
+from nlp.jobs import scheduler as translation_scheduler
+from nlp.model import init_model, model_ready
+from nlp.translate import translate_stored_conversation
 
 port = getenv("PORT") or 3000
+# worker processes share the preloaded model, threads within a worker
+# serve requests blocked on the DB or translation jobs
+WEB_WORKERS = int(getenv("WEB_WORKERS") or cpu_count())
+WEB_THREADS = int(getenv("WEB_THREADS") or 8)
+WEB_TIMEOUT = int(getenv("WEB_TIMEOUT") or 30)
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+MAX_SEND_BATCH_SIZE = int(getenv("MAX_SEND_BATCH_SIZE") or 1000)
+
+# set once init_app has finished in this process, see init_in_background
+initialized = Event()
+startup_failed = Event()
 
 app = Flask(__name__)
 
 
+@app.before_request
+def require_initialized():
+    # only the health checks answer while the model and DB are loading
+    if not initialized.is_set() and request.endpoint not in ("healthz", "readyz"):
+        return {"error": "server is starting up"}, 503
+
+
+# every handler call in a request shares one session and connection
+app.before_request(open_request_scope)
+app.teardown_request(close_request_scope)
+
+
+def find_users(user_ids):
+    """
+    Looks up the users a route was called with, whatever form their ids are in
+    @param user_ids: ids as given in the URL
+    @return: list of JSON in the order of user_ids, or raise ValueError if an
+    id isn't a UUID, LookupError if a user doesn't exist
+    """
+    ids = []
+    for user_id in user_ids:
+        try:
+            ids.append(UUID(str(user_id)))
+        except ValueError:
+            raise ValueError(f"invalid user id '{user_id}'")
+
+    users = user_handler.get_users_by_ids(ids)
+    for id in ids:
+        if str(id) not in users:
+            raise LookupError(f"user {id} not found")
+    return [users[str(id)] for id in ids]
+
+
 @app.route("/conversation/<user_1>/<user_2>", methods=["GET"])
 def get_conversation(user_1, user_2):
     if user_1 is None or user_2 is None:
         return {"error": "must provide user_1 and user_2 in request body"}, 400
 
-    conversation = message_handler.get_conversation(user_1, user_2)
-    conversation = sorted(conversation, key=lambda x: x["sent_at"])
+    try:
+        limit = min(int(request.args.get("limit", DEFAULT_PAGE_SIZE)), MAX_PAGE_SIZE)
+    except ValueError:
+        return {"error": "limit must be an integer"}, 400
+    if limit < 1:
+        return {"error": "limit must be positive"}, 400
 
-    tgt_lang = user_handler.get_user_by_id(user_1)["lang"]
-    src_lang = user_handler.get_user_by_id(user_2)["lang"]
+    try:
+        user_1, user_2 = find_users([user_1, user_2])
+        page = message_handler.get_conversation_page(
+            user_1["id"], user_2["id"], limit,
+            before=request.args.get("before"),
+            after=request.args.get("after"))
+    except ValueError as e:
+        return {"error": str(e)}, 400
+    except LookupError as e:
+        return {"error": str(e)}, 404
 
-    print(tgt_lang)
-    conversation = translate_conversation(conversation, src_lang, tgt_lang)
+    page["messages"] = translate_stored_conversation(page["messages"], user_1["lang"])
 
-    return {"messages": conversation}, 200
+    return page, 200
 
 
 @app.route("/last/<user_1>/<user_2>", methods=["GET"])
-def get_last_message(user1_id, user2_id):
-    if user1_id is None or user2_id is None:
+def get_last_message(user_1, user_2):
+    if user_1 is None or user_2 is None:
         return {"error": "must provide user_1 and user_2 in request body"}, 400
 
-    conversation = message_handler.get_conversation(user1_id, user2_id)
-    conversation = sorted(conversation, key=lambda x: x["sent_at"])
+    try:
+        user_1, user_2 = find_users([user_1, user_2])
+    except ValueError as e:
+        return {"error": str(e)}, 400
+    except LookupError as e:
+        return {"error": str(e)}, 404
+
+    message = message_handler.get_last_message(user_1["id"], user_2["id"])
+    if message is None:
+        return {"message": None}, 200
 
-    lang_pref = user_handler.get_user_by_id(user1_id)["lang"]
-    conversation = translate_conversation(conversation, lang_pref)
+    translate_stored_conversation([message], user_1["lang"])
 
-    return {"message": conversation[-2:-1]}, 200
+    return {"message": message}, 200
+
+
+@app.route("/last/<user_id>", methods=["GET"])
+def get_last_messages(user_id):
+    try:
+        user, = find_users([user_id])
+    except ValueError as e:
+        return {"error": str(e)}, 400
+    except LookupError as e:
+        return {"error": str(e)}, 404
+
+    messages = message_handler.get_last_messages(user["id"])
+    for message in messages:
+        message["partner"] = message["receiver"] \
+            if message["sender"] == user["id"] else message["sender"]
+    translate_stored_conversation(messages, user["lang"])
+
+    return {"messages": messages}, 200
 
 
 @app.route("/create/<name>", methods=["POST"])
@@ -55,6 +152,21 @@ def create_user(name):
     return user, 200
 
 
+@app.route("/user/<user_id>", methods=["PUT"])
+def update_user(user_id):
+    try:
+        user = user_handler.update_user(
+            user_id,
+            name=request.json.get("name"),
+            lang=request.json.get("lang"),
+        )
+    except RuntimeError as e:
+        return {"error": str(e)}, 404
+    except Exception:
+        return {"error": "couldn't update user"}, 500
+    return user, 200
+
+
 @app.route("/message/send", methods=["POST"])
 def send_message():
     try:
@@ -70,16 +182,160 @@ def send_message():
     return {"message_id": message["id"]}, 200
 
 
-def init_app():
-    print("initializing app...")
-    init_model()
+@app.route("/message/send_batch", methods=["POST"])
+def send_messages():
+    messages = (request.json or {}).get("messages")
+    if not isinstance(messages, list):
+        return {"error": "must provide a list of messages in request body"}, 400
+    if len(messages) > MAX_SEND_BATCH_SIZE:
+        return {"error": f"at most {MAX_SEND_BATCH_SIZE} messages per batch"}, 400
+
+    try:
+        message_ids = message_handler.create_messages(messages)
+    except ValueError as e:
+        return {"error": str(e)}, 400
+    except Exception:
+        return {"error": "couldn't send messages"}, 500
+    return {"message_ids": message_ids}, 200
+
+
+@app.route("/stats", methods=["GET"])
+def get_stats():
+    translation_stats = get_translation_stats()
+    return {
+        "translation_cache": translation_stats.get("translation_cache"),
+        "translation_memory": translation_stats.get("translation_memory"),
+        "models": translation_stats.get("models"),
+        "user_cache": user_handler.user_cache.stats,
+        "translation_scheduler": translation_scheduler.stats,
+        "db_pool": get_pool_stats(),
+    }, 200
+
+
+@app.route("/healthz", methods=["GET"])
+def healthz():
+    return {"status": "ok"}, 200
+
+
+@app.route("/readyz", methods=["GET"])
+def readyz():
+    checks = {"model": model_ready(), "db": db_ready()}
+    ready = all(checks.values())
+    return {"ready": ready, **checks}, 200 if ready else 503
+
+
+def init_db():
     init_db_connection()
     instantiate_tables()
 
 
+def init_app():
+    print("initializing app...")
+    # model loading and waiting on the DB overlap instead of adding up
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        model = executor.submit(init_model)
+        db = executor.submit(init_db)
+        model.result()
+        db.result()
+
+
+def init_in_background(on_ready, on_failure):
+    """
+    Runs init_app in a thread, so the server can bind and answer /healthz,
+    and /readyz with 503, while the model and DB are loading
+    @param on_ready: called once initialized is set
+    @param on_failure: called after init_app raised
+    """
+    def run():
+        try:
+            init_app()
+        except Exception:
+            print_exc()
+            startup_failed.set()
+            on_failure()
+            return
+        initialized.set()
+        on_ready()
+
+    Thread(target=run, name="init-app", daemon=True).start()
+
+
+class Server(BaseApplication):
+    """
+    Gunicorn serving the app. init_app runs once in the master, so forked
+    workers share the model weights copy-on-write instead of each loading
+    or training their own, and decode on them in their request threads.
+    With TRANSLATION_WORKERS set, decoding moves to process pools split
+    between the workers instead.
+
+    The master binds before init_app, see when_ready, so the workers forked
+    at startup only answer the health checks. Once init_app is done the
+    master reloads, replacing them with workers forked from the loaded
+    process.
+    """
+
+    def __init__(self, application, options):
+        self.application = application
+        self.options = options
+        super().__init__()
+
+    def load_config(self):
+        for key, value in self.options.items():
+            self.cfg.set(key, value)
+
+    def load(self):
+        return self.application
+
+
+def when_ready(server):
+    def reload_workers():
+        # keep the loaded model out of the GC's reach, so collections in the
+        # workers don't touch and copy its pages
+        freeze()
+        kill(getpid(), SIGHUP)
+
+    init_in_background(reload_workers, lambda: kill(getpid(), SIGTERM))
+
+
+def post_fork(server, worker):
+    dispose_after_fork()
+    # split the cores between workers instead of each using all of them,
+    # both for decoding in the worker and for translation pools
+    set_num_threads(max(cpu_count() // server.num_workers, 1))
+    # workers forked during startup are replaced once it's done, so they
+    # don't need a pool
+    if initialized.is_set():
+        split_pool(server.num_workers)
+
+
 def main():
-    init_app()
-    app.run(host="0.0.0.0", port=port)
+    parser = ArgumentParser(description="Run the messenger API.")
+    parser.add_argument("--workers", type=int, default=WEB_WORKERS)
+    parser.add_argument("--threads", type=int, default=WEB_THREADS)
+    parser.add_argument("--dev", action="store_true",
+                        help="use the single process Flask dev server")
+    args = parser.parse_args()
+
+    if args.dev:
+        init_in_background(lambda: None, interrupt_main)
+        app.run(host="0.0.0.0", port=port)
+    else:
+        try:
+            Server(app, {
+                "bind": f"0.0.0.0:{port}",
+                "workers": args.workers,
+                "threads": args.threads,
+                "worker_class": "gthread",
+                "timeout": WEB_TIMEOUT,
+                "when_ready": when_ready,
+                "post_fork": post_fork,
+            }).run()
+        except SystemExit:
+            if not startup_failed.is_set():
+                raise
+
+    if startup_failed.is_set():
+        raise SystemExit("app failed to initialize")
 
 
 if __name__ == "__main__":
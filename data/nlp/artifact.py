@@ -0,0 +1,256 @@
+from datetime import datetime
+from json import dump, load
+from os import getenv, listdir, makedirs, path, replace, rename
+from shutil import rmtree
+
+from torch import jit
+from torch import load as torch_load
+from torch import save as torch_save
+
+from nlp.vocab import Vocab
+
+ARTIFACT_DIR = getenv("MODEL_ARTIFACT_DIR") or "nlp/artifacts"
+ARTIFACT_FORMAT = 3
+LATEST_FILE = "LATEST"
+META_FILE = "meta.json"
+VOCAB_DIR = "vocab"
+OPTIMIZED_DIR = "optimized"
+
+
+def pair_name(src_lang, tgt_lang):
+    return f"{src_lang}-{tgt_lang}"
+
+
+def new_version():
+    return datetime.now().strftime("%Y%m%d%H%M%S")
+
+
+def decoder_attention(translator):
+    """
+    :return: attention mode shared by the translator's decoders
+    """
+    modes = {model["decoder"].attention
+             for tgts in translator.values() for model in tgts.values()}
+    if len(modes) != 1:
+        raise RuntimeError(f"Decoders use mixed attention modes {sorted(modes)}")
+    return modes.pop()
+
+
+def save_artifact(translator, vocab, max_length, mem_size,
+                  artifact_dir=ARTIFACT_DIR, version=None):
+    """
+    Saves trained models and vocabs to a versioned directory.
+    Layout:
+        <artifact_dir>/<version>/meta.json
+        <artifact_dir>/<version>/vocab/<lang>.json
+        <artifact_dir>/<version>/<src>-<tgt>.pt
+        <artifact_dir>/<version>/optimized/<src>-<tgt>.{encoder,decoder}.pt
+        <artifact_dir>/LATEST
+
+    The optimized TorchScript models are added later by save_optimized.
+
+    The version is written to a temp dir first and renamed into place, so
+    a reader never sees a half-written artifact.
+
+    :param translator: nested dict of src -> tgt -> {"encoder", "decoder"}
+    :param vocab: dict of lang -> Vocab
+    :param max_length: max sentence length the decoders were built with,
+        only sizes location attention
+    :param mem_size: hidden size of the encoders/decoders
+    :param artifact_dir: root artifact directory
+    :param version: version name, defaults to current timestamp
+    :return: version name
+    """
+    version = version or new_version()
+    version_dir = path.join(artifact_dir, version)
+    tmp_dir = version_dir + ".tmp"
+    if path.exists(tmp_dir):
+        rmtree(tmp_dir)
+    makedirs(path.join(tmp_dir, VOCAB_DIR))
+
+    pairs = []
+    for src_lang, tgts in translator.items():
+        for tgt_lang, model in tgts.items():
+            pairs.append(pair_name(src_lang, tgt_lang))
+            torch_save({
+                "encoder": model["encoder"].state_dict(),
+                "decoder": model["decoder"].state_dict(),
+            }, path.join(tmp_dir, pair_name(src_lang, tgt_lang) + ".pt"))
+
+    for lang, lang_vocab in vocab.items():
+        with open(path.join(tmp_dir, VOCAB_DIR, f"{lang}.json"), "w") as file:
+            dump(lang_vocab.to_dict(), file)
+
+    with open(path.join(tmp_dir, META_FILE), "w") as file:
+        dump({
+            "format": ARTIFACT_FORMAT,
+            "version": version,
+            "max_length": max_length,
+            "mem_size": mem_size,
+            "attention": decoder_attention(translator),
+            "langs": sorted(vocab.keys()),
+            "pairs": pairs,
+        }, file)
+
+    if path.exists(version_dir):
+        rmtree(version_dir)
+    rename(tmp_dir, version_dir)
+
+    latest_tmp = path.join(artifact_dir, LATEST_FILE + ".tmp")
+    with open(latest_tmp, "w") as file:
+        file.write(version)
+    replace(latest_tmp, path.join(artifact_dir, LATEST_FILE))
+
+    print(f"saved model artifact {version} to {artifact_dir}")
+    return version
+
+
+def latest_version(artifact_dir=ARTIFACT_DIR):
+    """
+    Gets the version LATEST points to, falling back to the newest
+    version directory.
+
+    :param artifact_dir: root artifact directory
+    :return: version name or None if there is no artifact
+    """
+    if not path.isdir(artifact_dir):
+        return None
+
+    latest = path.join(artifact_dir, LATEST_FILE)
+    if path.exists(latest):
+        with open(latest, "r") as file:
+            return file.read().strip()
+
+    versions = [name for name in listdir(artifact_dir)
+                if path.exists(path.join(artifact_dir, name, META_FILE))]
+    return max(versions) if versions else None
+
+
+def read_meta(artifact_dir, version):
+    """
+    :return: meta of an artifact version, None if it is missing or was
+        saved in another format
+    """
+    meta_file = path.join(artifact_dir, version, META_FILE)
+    if not path.exists(meta_file):
+        return None
+    with open(meta_file, "r") as file:
+        meta = load(file)
+    return meta if meta.get("format") == ARTIFACT_FORMAT else None
+
+
+def discover_pairs(artifact_dir=ARTIFACT_DIR, version=None):
+    """
+    Finds every translation pair saved in artifact_dir. A pair saved in
+    several versions comes from LATEST if it has it, otherwise from the
+    newest version that does, so a direction trained on its own artifact
+    is served next to the ones it didn't retrain.
+
+    :param artifact_dir: root artifact directory
+    :param version: only look in this version
+    :return: dict of (src, tgt) -> version
+    """
+    if version is not None:
+        versions = [version]
+    elif path.isdir(artifact_dir):
+        latest = latest_version(artifact_dir)
+        versions = sorted((name for name in listdir(artifact_dir)
+                           if name != latest and not name.endswith(".tmp")),
+                          reverse=True)
+        versions = [latest] + versions if latest else versions
+    else:
+        versions = []
+
+    pairs = {}
+    for name in versions:
+        meta = read_meta(artifact_dir, name)
+        if meta is None:
+            continue
+        for pair in meta["pairs"]:
+            pairs.setdefault(tuple(pair.split("-")), name)
+    return pairs
+
+
+def pair_files(artifact_dir, version, src_lang, tgt_lang, optimized=False):
+    """
+    :return: paths of the files a pair loads, weights first
+    """
+    version_dir = path.join(artifact_dir, version)
+    pair = pair_name(src_lang, tgt_lang)
+    if optimized:
+        weights = [path.join(version_dir, OPTIMIZED_DIR, f"{pair}.{part}.pt")
+                   for part in ["encoder", "decoder"]]
+    else:
+        weights = [path.join(version_dir, pair + ".pt")]
+    return weights + [path.join(version_dir, VOCAB_DIR, f"{lang}.json")
+                      for lang in [src_lang, tgt_lang]]
+
+
+def load_pair(artifact_dir, version, src_lang, tgt_lang, map_location=None):
+    """
+    Loads one pair of an artifact with just the two vocabs it uses.
+
+    :return: {"meta", "vocab", "state"} with state holding the pair's
+        encoder and decoder weights
+    """
+    version_dir = path.join(artifact_dir, version)
+    meta = read_meta(artifact_dir, version)
+    if meta is None:
+        raise RuntimeError(
+            f"Model artifact {version} is missing or not format {ARTIFACT_FORMAT}")
+
+    vocab = {}
+    for lang in {src_lang, tgt_lang}:
+        with open(path.join(version_dir, VOCAB_DIR, f"{lang}.json"), "r") as file:
+            vocab[lang] = Vocab.from_dict(load(file))
+
+    state = torch_load(path.join(version_dir, pair_name(src_lang, tgt_lang) + ".pt"),
+                       map_location=map_location)
+    return {"meta": meta, "vocab": vocab, "state": state}
+
+
+def save_optimized(translator, artifact_dir=ARTIFACT_DIR, version=None):
+    """
+    Saves TorchScript models next to the eager weights of an artifact.
+
+    :param translator: nested dict of src -> tgt -> scripted {"encoder", "decoder"}
+    :param artifact_dir: root artifact directory
+    :param version: artifact version, defaults to latest
+    """
+    version = version or latest_version(artifact_dir)
+    optimized_dir = path.join(artifact_dir, version, OPTIMIZED_DIR)
+    makedirs(optimized_dir, exist_ok=True)
+
+    for src_lang, tgts in translator.items():
+        for tgt_lang, model in tgts.items():
+            for part in ["encoder", "decoder"]:
+                part_file = f"{pair_name(src_lang, tgt_lang)}.{part}.pt"
+                jit.save(model[part], path.join(optimized_dir, part_file + ".tmp"))
+                replace(path.join(optimized_dir, part_file + ".tmp"),
+                        path.join(optimized_dir, part_file))
+
+    print(f"saved optimized models to {optimized_dir}")
+
+
+def load_optimized(pairs, artifact_dir=ARTIFACT_DIR, version=None, map_location=None):
+    """
+    Loads the TorchScript models saved with save_optimized.
+
+    :param pairs: pair names from the artifact meta
+    :return: nested dict of src -> tgt -> {"encoder", "decoder"} or None if
+        the artifact has no optimized models
+    """
+    version = version or latest_version(artifact_dir)
+    optimized_dir = path.join(artifact_dir, version, OPTIMIZED_DIR)
+
+    translator = {}
+    for pair in pairs:
+        src_lang, tgt_lang = pair.split("-")
+        model = {}
+        for part in ["encoder", "decoder"]:
+            part_path = path.join(optimized_dir, f"{pair}.{part}.pt")
+            if not path.exists(part_path):
+                return None
+            model[part] = jit.load(part_path, map_location=map_location)
+        translator.setdefault(src_lang, {})[tgt_lang] = model
+    return translator
@@ -0,0 +1,164 @@
+"""
+On-disk cache of the preprocessed dataset.
+Layout:
+    <corpus_dir>/meta.json
+    <corpus_dir>/<lang>.txt           normalized sentences, one per line
+    <corpus_dir>/<lang>.ids.npy       every sentence's indices, flat int32
+    <corpus_dir>/<lang>.offsets.npy   sentence i is ids[offsets[i]:offsets[i + 1]]
+    <corpus_dir>/test.npy             held-out sentence numbers, sorted
+    <corpus_dir>/vocab/<lang>.json
+    <corpus_dir>/memory/              translation memory, see nlp.memory
+
+The index arrays are memory-mapped, so training touches only the sentences
+it is currently using.
+"""
+from array import array
+from json import dump, load
+from os import getenv, makedirs, path, remove, stat
+
+from numpy import asarray, frombuffer, int32, int64
+from numpy import load as np_load
+from numpy import save as np_save
+from numpy import zeros as np_zeros
+from torch import from_numpy
+
+from nlp.vocab import Vocab
+
+CORPUS_DIR = getenv("CORPUS_CACHE_DIR") or "nlp/corpus"
+CORPUS_FORMAT = 5
+META_FILE = "meta.json"
+TEST_FILE = "test.npy"
+VOCAB_DIR = "vocab"
+
+
+def text_path(corpus_dir, lang):
+    return path.join(corpus_dir, f"{lang}.txt")
+
+
+def source_stamp(filename, max_size, settings=None):
+    """
+    Identifies the source file and settings a corpus was built from, so
+    edits to the file, a new size cap or new settings invalidate the cache.
+    """
+    file_stat = stat(filename)
+    return {
+        "format": CORPUS_FORMAT,
+        "source": path.abspath(filename),
+        "source_size": file_stat.st_size,
+        "source_mtime": file_stat.st_mtime,
+        "max_size": max_size,
+        "settings": settings or {},
+    }
+
+
+def corpus_is_fresh(corpus_dir, filename, max_size, settings=None):
+    """
+    :return: True if corpus_dir holds a complete corpus built from filename
+    """
+    meta_file = path.join(corpus_dir, META_FILE)
+    if not path.exists(meta_file):
+        return False
+    with open(meta_file, "r") as file:
+        meta = load(file)
+    stamp = source_stamp(filename, max_size, settings)
+    return all(meta.get(key) == value for key, value in stamp.items())
+
+
+def open_normalized(corpus_dir, langs):
+    """
+    Starts a new corpus, truncating any normalized text already there.
+
+    :return: dict of lang -> open text file
+    """
+    makedirs(path.join(corpus_dir, VOCAB_DIR), exist_ok=True)
+    meta_file = path.join(corpus_dir, META_FILE)
+    if path.exists(meta_file):
+        remove(meta_file)
+    return {lang: open(text_path(corpus_dir, lang), "w") for lang in langs}
+
+
+def iter_normalized(corpus_dir, lang):
+    """
+    Streams normalized sentences of one language.
+
+    :return: iterable of strings
+    """
+    with open(text_path(corpus_dir, lang), "r") as file:
+        for line in file:
+            yield line.rstrip("\n")
+
+
+def write_indices(corpus_dir, lang, sequences, num_sentences):
+    """
+    Writes index sequences as one flat int32 array plus an offsets array.
+
+    :param sequences: iterable of index lists, one per sentence
+    :param num_sentences: number of sentences in sequences
+    """
+    offsets = np_zeros(num_sentences + 1, dtype=int64)
+    flat = array("i")
+    for i, indices in enumerate(sequences):
+        flat.extend(indices)
+        offsets[i + 1] = len(flat)
+
+    ids = frombuffer(flat, dtype=int32)
+    np_save(path.join(corpus_dir, f"{lang}.ids.npy"), ids)
+    np_save(path.join(corpus_dir, f"{lang}.offsets.npy"), offsets)
+
+
+def write_test_rows(corpus_dir, rows):
+    """
+    Saves the sentence numbers held out from training, so evaluation sees
+    the same split training did.
+    """
+    np_save(path.join(corpus_dir, TEST_FILE), asarray(sorted(rows), dtype=int64))
+
+
+def save_corpus_meta(corpus_dir, filename, max_size, langs, vocab,
+                     num_sentences, max_length, settings=None):
+    """
+    Saves vocabs and meta. Written last, so a corpus without meta is
+    treated as incomplete.
+    """
+    for lang in langs:
+        with open(path.join(corpus_dir, VOCAB_DIR, f"{lang}.json"), "w") as file:
+            dump(vocab[lang].to_dict(), file)
+
+    meta = source_stamp(filename, max_size, settings)
+    meta.update({
+        "langs": langs,
+        "num_sentences": num_sentences,
+        "max_length": max_length,
+    })
+    with open(path.join(corpus_dir, META_FILE), "w") as file:
+        dump(meta, file)
+
+
+def load_corpus(corpus_dir=CORPUS_DIR):
+    """
+    Opens a preprocessed corpus with its index arrays memory-mapped.
+
+    :return: {"meta", "vocab", "ids", "offsets", "test"}
+    """
+    with open(path.join(corpus_dir, META_FILE), "r") as file:
+        meta = load(file)
+
+    corpus = {"meta": meta, "vocab": {}, "ids": {}, "offsets": {},
+              "test": np_load(path.join(corpus_dir, TEST_FILE))}
+    for lang in meta["langs"]:
+        with open(path.join(corpus_dir, VOCAB_DIR, f"{lang}.json"), "r") as file:
+            corpus["vocab"][lang] = Vocab.from_dict(load(file))
+        corpus["ids"][lang] = np_load(
+            path.join(corpus_dir, f"{lang}.ids.npy"), mmap_mode="r")
+        corpus["offsets"][lang] = np_load(
+            path.join(corpus_dir, f"{lang}.offsets.npy"), mmap_mode="r")
+    return corpus
+
+
+def corpus_tensor(corpus, lang, i, device=None):
+    """
+    Sentence i as a (length, 1) index tensor, read straight from the map.
+    """
+    offsets = corpus["offsets"][lang]
+    ids = corpus["ids"][lang][offsets[i]:offsets[i + 1]]
+    return from_numpy(ids.astype(int64)).to(device).view(-1, 1)
@@ -0,0 +1,65 @@
+"""
+Exports an artifact's models for CPU inference: Linear and GRU layers get
+dynamic int8 quantization, then the encode and decode steps are compiled
+with TorchScript. Load the result with INFERENCE_MODE=optimized.
+
+Run from the data directory after python -m nlp.train:
+    python -m nlp.export [--version VERSION]
+"""
+from argparse import ArgumentParser
+
+from torch import jit, qint8
+from torch.ao.quantization import quantize_dynamic
+from torch.nn import GRU, Linear
+
+import nlp.model as model
+from nlp.artifact import ARTIFACT_DIR, latest_version, save_optimized
+
+
+def optimize_model(encoder, decoder):
+    """
+    :param encoder: eager Encoder in eval mode
+    :param decoder: eager Decoder in eval mode
+    :return: {"encoder", "decoder"} as quantized ScriptModules exposing the
+        same encode/step methods
+    """
+    return {
+        "encoder": jit.script(quantize_dynamic(encoder, {Linear, GRU}, dtype=qint8)),
+        "decoder": jit.script(quantize_dynamic(decoder, {Linear, GRU}, dtype=qint8)),
+    }
+
+
+def export_optimized(artifact_dir=ARTIFACT_DIR, version=None):
+    """
+    Quantizes and scripts every pair of an artifact and saves the result
+    inside it.
+
+    :param artifact_dir: root artifact directory
+    :param version: artifact version, defaults to latest
+    :return: optimized translator dict
+    """
+    version = version or latest_version(artifact_dir)
+    if version is None or not model.load_models(artifact_dir, version, mode="eager",
+                                                preload=[]):
+        raise RuntimeError(f"No model artifact found in {artifact_dir}")
+
+    optimized = {}
+    for src_lang, tgt_lang in model.registry.available:
+        encoder, decoder = model.get_translator(src_lang, tgt_lang)
+        optimized.setdefault(src_lang, {})[tgt_lang] = optimize_model(
+            encoder.cpu(), decoder.cpu())
+
+    save_optimized(optimized, artifact_dir, model.model_version)
+    return optimized
+
+
+def main():
+    parser = ArgumentParser(description="Export quantized TorchScript models.")
+    parser.add_argument("--version", default=None)
+    args = parser.parse_args()
+
+    export_optimized(ARTIFACT_DIR, args.version)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,243 @@
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from multiprocessing import get_context
+from os import getenv, getpid
+from threading import Lock
+
+import db.handlers.translation_handler as translation_handler
+from nlp.scheduler import MicroBatcher
+
+# translation processes for the whole server. 0 decodes in the calling
+# process, so gunicorn workers use the models preloaded before the fork
+TRANSLATION_WORKERS = int(getenv("TRANSLATION_WORKERS") or 0)
+TRANSLATION_TIMEOUT = float(getenv("TRANSLATION_TIMEOUT") or 2)
+
+# created lazily so each server process owns its own pool, of pool_size
+# processes after split_pool
+pool_size = TRANSLATION_WORKERS
+_pool = None
+_pool_pid = None
+_pool_lock = Lock()
+
+# pid -> latest process_stats each pool worker sent back with a job result
+_worker_stats = {}
+_worker_stats_lock = Lock()
+# per process counters that add up across workers
+ADDITIVE_STATS = ["size", "hits", "misses", "evictions", "lookups", "loads"]
+
+
+def _init_worker():
+    """
+    Runs once in each worker process: loads the preloaded pairs and the
+    translation memory so jobs for them never pay for loading. Other pairs
+    load on their first job.
+    """
+    from torch import set_num_threads
+
+    import nlp.model as model
+
+    # one core per worker, the pool provides the parallelism
+    set_num_threads(1)
+    if not model.load_models():
+        raise RuntimeError(
+            f"Translation worker found no model artifact in {model.ARTIFACT_DIR}")
+    model.load_translation_memory()
+
+
+def _translate(contents, src_lang, tgt_lang):
+    """
+    :return: list of translated strings
+    """
+    from nlp.model import get_translator, translate_batch
+
+    encoder, decoder = get_translator(src_lang, tgt_lang)
+    translations = translate_batch(
+        contents, encoder, decoder, src_lang, tgt_lang)
+    return [" ".join(translation) for translation in translations]
+
+
+def _translate_job(contents, src_lang, tgt_lang):
+    """
+    Runs in a worker process.
+
+    :return: list of translated strings, the worker's process_stats
+    """
+    return _translate(contents, src_lang, tgt_lang), process_stats()
+
+
+def process_stats():
+    """
+    :return: translation counters of this process, by /stats section
+    """
+    import nlp.model as model
+
+    return {
+        "pid": getpid(),
+        "translation_cache": model.translation_cache.stats,
+        "translation_memory": model.translation_memory_stats(),
+        "models": model.registry.stats,
+    }
+
+
+def get_translation_stats():
+    """
+    Translation counters of the processes that translate for this one:
+    this process when decoding inline, otherwise the pool workers as of
+    their latest job, summed, with each worker's own under "workers".
+
+    :return: dict of /stats section -> JSON
+    """
+    if pool_size <= 0:
+        stats = process_stats()
+        del stats["pid"]
+        return stats
+
+    with _worker_stats_lock:
+        workers = list(_worker_stats.values())
+    sections = {}
+    for worker in workers:
+        for section, stats in worker.items():
+            if section == "pid" or stats is None:
+                continue
+            combined = sections.setdefault(section, {"processes": 0, "workers": {}})
+            combined["processes"] += 1
+            combined["workers"][worker["pid"]] = stats
+            for key in ADDITIVE_STATS:
+                if key in stats:
+                    combined[key] = combined.get(key, 0) + stats[key]
+
+    for combined in sections.values():
+        if "lookups" in combined or "misses" in combined:
+            lookups = combined.get("lookups", combined["hits"] + combined.get("misses", 0))
+            combined["hit_rate"] = combined["hits"] / lookups if lookups else 0.0
+    return sections
+
+
+def get_pool():
+    """
+    Gets this process's worker pool, creating it on first use. Workers are
+    spawned rather than forked so they never inherit torch threads or open
+    DB connections.
+
+    :return: ProcessPoolExecutor or None when TRANSLATION_WORKERS is 0
+    """
+    global _pool, _pool_pid
+    if pool_size <= 0:
+        return None
+
+    with _pool_lock:
+        if _pool is None or _pool_pid != getpid():
+            print(f"starting {pool_size} translation workers...")
+            _pool = ProcessPoolExecutor(
+                max_workers=pool_size,
+                mp_context=get_context("spawn"),
+                initializer=_init_worker,
+            )
+            _pool_pid = getpid()
+        return _pool
+
+
+def split_pool(num_processes):
+    """
+    Shares TRANSLATION_WORKERS between the server's processes, so their
+    pools together hold that many translation processes rather than that
+    many each. Starts this process's pool, so workers load their models
+    before the first request instead of during it.
+
+    :param num_processes: number of server processes, each with a pool
+    """
+    global pool_size
+    if TRANSLATION_WORKERS <= 0:
+        return
+    pool_size = max(TRANSLATION_WORKERS // num_processes, 1)
+    pool = get_pool()
+    for _ in range(pool_size):
+        pool.submit(getpid)
+
+
+def run_batch(contents, src_lang, tgt_lang):
+    """
+    Runs one scheduler batch on the worker pool, or right here when there
+    are no workers.
+
+    :return: Future resolving to the list of translated strings
+    """
+    future = Future()
+    pool = get_pool()
+    if pool is None:
+        try:
+            future.set_result(_translate(contents, src_lang, tgt_lang))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+    def unpack(job):
+        if job.exception() is not None:
+            future.set_exception(job.exception())
+            return
+        translations, stats = job.result()
+        with _worker_stats_lock:
+            _worker_stats[stats["pid"]] = stats
+        future.set_result(translations)
+
+    pool.submit(_translate_job, contents, src_lang, tgt_lang).add_done_callback(unpack)
+    return future
+
+
+# merges concurrent requests into one job per language pair
+scheduler = MicroBatcher(run_batch)
+
+
+def submit_translations(message_ids, contents, src_lang, tgt_lang):
+    """
+    Submits messages to the scheduler, which batches them with other
+    requests for the same pair. The results are stored as soon as they're
+    ready, whether or not anyone waits on them.
+
+    :param message_ids: UUIDs of the messages
+    :param contents: original message texts
+    :param src_lang: language of contents
+    :param tgt_lang: language to translate into
+    :return: Future resolving to the list of translated strings
+    """
+    future = scheduler.submit_many(contents, src_lang, tgt_lang)
+
+    def store(done):
+        if done.exception() is not None:
+            print(f"failed to translate messages {message_ids}: {done.exception()}")
+            return
+        translation_handler.save_translations(
+            list(zip(message_ids, done.result())), tgt_lang)
+
+    future.add_done_callback(store)
+    return future
+
+
+def enqueue_translation(message_id, content, src_lang, tgt_lang):
+    """
+    Queues a message to be translated and stored in the background.
+
+    :param message_id: UUID of the message
+    :param content: original message text
+    :param src_lang: language of content
+    :param tgt_lang: language to translate into
+    :return: Future resolving to the list with one translated string
+    """
+    return submit_translations([message_id], [content], src_lang, tgt_lang)
+
+
+def await_translations(future, timeout=TRANSLATION_TIMEOUT):
+    """
+    Waits for a submitted job.
+
+    :param future: Future from submit_translations
+    :param timeout: seconds to wait
+    :return: list of translated strings, None if still pending or the job
+        failed, which submit_translations already logs
+    """
+    try:
+        return future.result(timeout=timeout)
+    except FutureTimeoutError:
+        return None
+    except Exception:
+        return None
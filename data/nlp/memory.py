@@ -0,0 +1,226 @@
+"""
+Translation memory: the corpus's human reference translations, looked up by
+exact normalized source text before anything is decoded. References are
+served normalized, the same form the decoder produces, so a translation
+reads the same whether or not its sentence is in the corpus.
+Layout:
+    <corpus_dir>/memory/<lang>.norm.bin            normalized sentences, utf-8
+    <corpus_dir>/memory/<lang>.norm.offsets.npy    sentence i is norm[offsets[i]:offsets[i + 1]]
+    <corpus_dir>/memory/<lang>.text.bin            original sentences, utf-8
+    <corpus_dir>/memory/<lang>.text.offsets.npy
+    <corpus_dir>/memory/<lang>.index.npy           (slots, 2) hash table of
+                                                   (sentence hash, sentence + 1)
+
+Sentence i of every language translates sentence i of the others, so one
+index per language serves every direction out of it. Everything is
+memory-mapped, so a lookup touches a table slot or two and one sentence.
+"""
+from hashlib import blake2b
+from json import load
+from mmap import ACCESS_READ, mmap
+from os import makedirs, path
+from threading import Lock
+from time import perf_counter
+
+from numpy import array, int64, uint64
+from numpy import load as np_load
+from numpy import save as np_save
+
+from nlp.corpus import META_FILE, iter_normalized
+
+MEMORY_DIR = "memory"
+# table slots per indexed sentence, keeps probe chains short
+SLOTS_PER_SENTENCE = 2
+
+
+def sentence_hash(sentence):
+    """
+    64 bit hash that is the same in every process, unlike hash()
+
+    :return: nonzero int
+    """
+    digest = blake2b(sentence.encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "little") or 1
+
+
+def memory_path(corpus_dir, lang, name):
+    return path.join(corpus_dir, MEMORY_DIR, f"{lang}.{name}")
+
+
+def write_strings(corpus_dir, lang, name, strings):
+    """
+    Writes strings as one utf-8 blob plus an offsets array.
+    """
+    offsets = [0]
+    with open(memory_path(corpus_dir, lang, f"{name}.bin"), "wb") as file:
+        for string in strings:
+            offsets.append(offsets[-1] + file.write(string.encode("utf-8")))
+    np_save(memory_path(corpus_dir, lang, f"{name}.offsets.npy"),
+            array(offsets, dtype=int64))
+
+
+def write_index(corpus_dir, lang, sentences, num_sentences):
+    """
+    Builds a linear probing hash table over normalized sentences. A sentence
+    seen more than once keeps its first translation, empty ones aren't
+    indexed.
+    """
+    num_slots = 1
+    while num_slots < num_sentences * SLOTS_PER_SENTENCE:
+        num_slots *= 2
+    mask = num_slots - 1
+    hashes = [0] * num_slots
+    rows = [0] * num_slots
+
+    for i, sentence in enumerate(sentences):
+        if not sentence:
+            continue
+        key = sentence_hash(sentence)
+        slot = key & mask
+        while rows[slot] and hashes[slot] != key:
+            slot = (slot + 1) & mask
+        if not rows[slot]:
+            hashes[slot] = key
+            rows[slot] = i + 1
+
+    table = array([hashes, rows], dtype=uint64).T.copy()
+    np_save(memory_path(corpus_dir, lang, "index.npy"), table)
+
+
+def build_memory(corpus_dir, filename, langs, num_sentences):
+    """
+    Writes the translation memory of a corpus whose normalized text is
+    already in corpus_dir, taking the original sentences from filename.
+
+    :param corpus_dir: corpus directory
+    :param filename: dataset the corpus was built from
+    :param langs: language codes in the order of the file's columns
+    :param num_sentences: number of sentences in the corpus
+    """
+    makedirs(path.join(corpus_dir, MEMORY_DIR), exist_ok=True)
+
+    def originals(column):
+        with open(filename, "r") as file:
+            for i, datum in enumerate(file):
+                if i >= num_sentences:
+                    break
+                yield datum.rstrip("\n").split('\t')[column].strip()
+
+    for column, lang in enumerate(langs):
+        write_strings(corpus_dir, lang, "norm", iter_normalized(corpus_dir, lang))
+        write_strings(corpus_dir, lang, "text", originals(column))
+        write_index(corpus_dir, lang, iter_normalized(corpus_dir, lang),
+                    num_sentences)
+    print(f"indexed {num_sentences} sentences into the translation memory")
+
+
+class MappedStrings:
+    """
+    Read-only view of a blob written by write_strings.
+    """
+
+    def __init__(self, corpus_dir, lang, name):
+        with open(memory_path(corpus_dir, lang, f"{name}.bin"), "rb") as file:
+            # mmap can't map an empty file
+            self.blob = mmap(file.fileno(), 0, access=ACCESS_READ) \
+                if path.getsize(file.name) else b""
+        self.offsets = np_load(
+            memory_path(corpus_dir, lang, f"{name}.offsets.npy"), mmap_mode="r")
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return self.blob[int(self.offsets[i]):int(self.offsets[i + 1])].decode("utf-8")
+
+
+class TranslationMemory:
+    """
+    Exact match lookups into a memory written by build_memory, with hit
+    counters for /stats.
+    """
+
+    def __init__(self, corpus_dir, langs):
+        self.langs = list(langs)
+        self.index = {}
+        self.norm = {}
+        self.text = {}
+        for lang in self.langs:
+            self.index[lang] = np_load(memory_path(corpus_dir, lang, "index.npy"),
+                                       mmap_mode="r")
+            self.norm[lang] = MappedStrings(corpus_dir, lang, "norm")
+            self.text[lang] = MappedStrings(corpus_dir, lang, "text")
+
+        self._lock = Lock()
+        self.lookups = 0
+        self.hits = 0
+        self.lookup_time = 0.0
+
+    def find(self, norm_msg, lang):
+        """
+        :return: number of the first corpus sentence equal to norm_msg, or None
+        """
+        table = self.index[lang]
+        mask = len(table) - 1
+        key = sentence_hash(norm_msg)
+        slot = key & mask
+        while True:
+            slot_key, row = table[slot].tolist()
+            if not row:
+                return None
+            if slot_key == key and self.norm[lang][row - 1] == norm_msg:
+                return row - 1
+            slot = (slot + 1) & mask
+
+    def lookup(self, norm_msg, src_lang, tgt_lang):
+        """
+        :param norm_msg: string already passed through normalize
+        :param src_lang: language of norm_msg
+        :param tgt_lang: language to translate to
+        :return: normalized reference translation, None if norm_msg isn't in
+            the corpus or either language isn't indexed
+        """
+        if src_lang not in self.index or tgt_lang not in self.norm or not norm_msg:
+            return None
+
+        start = perf_counter()
+        row = self.find(norm_msg, src_lang)
+        translation = None if row is None else self.norm[tgt_lang][row]
+        elapsed = perf_counter() - start
+        with self._lock:
+            self.lookups += 1
+            self.hits += translation is not None
+            self.lookup_time += elapsed
+        return translation
+
+    @property
+    def stats(self):
+        """
+        :return: hit counters for /stats
+        """
+        with self._lock:
+            return {
+                "sentences": len(self.text[self.langs[0]]) if self.langs else 0,
+                "lookups": self.lookups,
+                "hits": self.hits,
+                "hit_rate": self.hits / self.lookups if self.lookups else 0.0,
+                "mean_lookup_us": self.lookup_time / self.lookups * 1e6
+                if self.lookups else 0.0,
+            }
+
+
+def open_memory(corpus_dir):
+    """
+    Opens the translation memory of a complete corpus.
+
+    :return: TranslationMemory, None if corpus_dir has no complete corpus
+        or it was built without a memory
+    """
+    meta_file = path.join(corpus_dir, META_FILE)
+    if not path.exists(meta_file):
+        return None
+    with open(meta_file, "r") as file:
+        langs = load(file)["langs"]
+    if not all(path.exists(memory_path(corpus_dir, lang, "index.npy")) for lang in langs):
+        return None
+    return TranslationMemory(corpus_dir, langs)
@@ -1,14 +1,27 @@
-from json import loads
-from random import shuffle
+from os import getenv
+from random import Random, random, shuffle
+from threading import Lock
+from time import perf_counter
 
 from spacy import load
-from torch import device, long, no_grad, tensor, zeros
+from torch import bool as torch_bool
+from torch import arange, device, full, long, no_grad, stack, tensor, zeros
 from torch.cuda import is_available as cuda_is_available
-from torch.nn.modules.loss import CrossEntropyLoss
+from torch.nn.functional import pad
+from torch.nn.modules.loss import NLLLoss
+from torch.nn.utils.rnn import pad_sequence
 from torch.optim import SGD
 
+from cache import LRUCache
+from nlp.artifact import (ARTIFACT_DIR, latest_version, load_optimized,
+                          load_pair, pair_files, pair_name, save_artifact)
+from nlp.corpus import (CORPUS_DIR, corpus_is_fresh, corpus_tensor,
+                        iter_normalized, load_corpus, open_normalized,
+                        save_corpus_meta, write_indices, write_test_rows)
+from nlp.memory import build_memory, open_memory
+from nlp.registry import ModelRegistry
 from nlp.rnn import Decoder, Encoder
-from nlp.vocab import EOS_TOKEN, SOS_TOKEN, Vocab
+from nlp.vocab import EOS_TOKEN, SOS_TOKEN, Vocab, train_tokenizer
 
 DEVICE = device("cuda" if cuda_is_available() else "cpu")
 
@@ -16,12 +29,78 @@ DATASET_FILE = "nlp/tatoeba.txt"
 LANGS = ["en", "es"]
 SRC_LANG = "en"
 TGT_LANG = "es"
-MAX_DATASET_SIZE = 5000
-
-
-def load_dataset(filename, src_lang, tgt_lang):
+# 0 or unset trains on the full corpus
+MAX_DATASET_SIZE = int(getenv("MAX_DATASET_SIZE") or 0) or None
+PREPROCESS_CHUNK_SIZE = 10000
+# share of the corpus held out from training, drawn once when it's
+# preprocessed and seeded, so a rebuilt corpus holds out the same rows
+TEST_SPLIT = float(getenv("TEST_SPLIT") or .2)
+TEST_SPLIT_SEED = 0
+# rarer words than this are dropped from the vocab and encode as UNK
+VOCAB_MIN_FREQ = int(getenv("VOCAB_MIN_FREQ") or 1)
+VOCAB_MAX_WORDS = int(getenv("VOCAB_MAX_WORDS") or 0) or None
+# "whitespace" keeps whole words, "bpe" learns subwords from the corpus
+TOKENIZER = getenv("TOKENIZER") or "whitespace"
+BPE_MERGES = int(getenv("BPE_MERGES") or 8000)
+TRAIN_EPOCHS = int(getenv("TRAIN_EPOCHS") or 10)
+# init_model trains this small a model when no artifact is found, so the
+# backend comes up quickly, python -m nlp.train trains the real one
+BOOT_TRAIN_MAX_SIZE = int(getenv("BOOT_TRAIN_MAX_SIZE") or 5000)
+BOOT_TRAIN_EPOCHS = int(getenv("BOOT_TRAIN_EPOCHS") or 1)
+TRAIN_BATCH_SIZE = int(getenv("TRAIN_BATCH_SIZE") or 64)
+TRAIN_LR = float(getenv("TRAIN_LR") or 0.1)
+TEACHER_FORCING_RATIO = float(getenv("TEACHER_FORCING_RATIO") or 0.5)
+# batches per length-sorted bucket
+BUCKET_BATCHES = 50
+MEM_SIZE = 256
+# decoder attention for new models, see nlp.rnn.ATTENTION_MODES
+ATTENTION = getenv("ATTENTION") or "general"
+# without a fixed attention window, decoding stops after this many
+# output tokens per input token plus the slack
+OUTPUT_LENGTH_RATIO = 2
+OUTPUT_LENGTH_SLACK = 10
+NORMALIZE_BATCH_SIZE = int(getenv("NORMALIZE_BATCH_SIZE") or 1000)
+NORMALIZE_PROCESSES = int(getenv("NORMALIZE_PROCESSES") or 1)
+# normalize only reads pos_ and is_punct, so skip everything else
+UNUSED_PIPES = ["parser", "ner", "lemmatizer", "senter"]
+# spaCy pipeline per language, others default to <lang>_core_news_sm
+SPACY_MODELS = {"en": "en_core_web_sm", "es": "es_core_news_sm"}
+# "eager" fp32 models or "optimized" int8 TorchScript from python -m nlp.export
+INFERENCE_MODE = getenv("INFERENCE_MODE") or "eager"
+# 1 decodes greedily in one batch, wider beams trade latency for quality
+# and search each sentence of a batch in turn
+BEAM_WIDTH = int(getenv("BEAM_WIDTH") or 1)
+LENGTH_PENALTY = float(getenv("LENGTH_PENALTY") or 0.6)
+TRANSLATION_CACHE_SIZE = int(getenv("TRANSLATION_CACHE_SIZE") or 10000)
+TRANSLATION_CACHE_TTL = float(getenv("TRANSLATION_CACHE_TTL") or 3600)
+# serve sentences found in the corpus with their reference translation
+TRANSLATION_MEMORY = (getenv("TRANSLATION_MEMORY") or "1") != "0"
+# pairs load_models loads right away, comma separated, the rest load on
+# first use. "" for none
+MODEL_PRELOAD = [tuple(pair.split("-")) for pair in getenv(
+    "MODEL_PRELOAD", f"{SRC_LANG}-{TGT_LANG},{TGT_LANG}-{SRC_LANG}").split(",") if pair]
+
+# keyed by (normalized text, src lang, tgt lang, decoding settings),
+# cleared on model load
+translation_cache = LRUCache(TRANSLATION_CACHE_SIZE, TRANSLATION_CACHE_TTL)
+
+# set in load_translation_memory, None when there is no memory to consult
+translation_memory = None
+
+# spaCy pipelines loaded so far, see get_pipeline
+tokenizer = {}
+_tokenizer_lock = Lock()
+
+# set in init_model
+model_version = None
+
+
+def preprocess_dataset(filename, src_lang, tgt_lang, corpus_dir=CORPUS_DIR,
+                       max_size=MAX_DATASET_SIZE):
     """
-    Loads dataset.
+    Normalizes, builds vocabs for and tensorizes the dataset, writing the
+    result to corpus_dir. The file is streamed in chunks, so memory use
+    doesn't grow with the corpus.
     File must consist of line-separated translations, where each
     sentence is tab-separated.
     Ex:
@@ -32,45 +111,122 @@ def load_dataset(filename, src_lang, tgt_lang):
     :param filename: name of dataset file
     :param src_lang: language code for first language appearing in file
     :param tgt_lang: language code for second language appearing in file
-    :return: json list
+    :param corpus_dir: directory to write the corpus to
+    :param max_size: max number of lines to use, None for all of them
     """
-    global max_length
+    langs = [src_lang, tgt_lang]
     max_length = 0
+    num_sentences = 0
+
+    def flush(chunk, outputs):
+        for lang, data in zip(langs, chunk):
+            for norm_msg in normalize_batch(data, lang):
+                outputs[lang].write(norm_msg + "\n")
+
+    outputs = open_normalized(corpus_dir, langs)
+    try:
+        chunk = ([], [])
+        with open(filename, "r") as file:
+            for datum in file:
+                if max_size is not None and num_sentences >= max_size:
+                    break
+                datum = datum.rstrip("\n").split('\t')
+                max_length = max(max_length, len(datum[0]), len(datum[1]))
+                chunk[0].append(datum[0])
+                chunk[1].append(datum[1])
+                num_sentences += 1
+
+                if len(chunk[0]) == PREPROCESS_CHUNK_SIZE:
+                    flush(chunk, outputs)
+                    chunk = ([], [])
+                    print(f"{num_sentences} lines processed.")
+        flush(chunk, outputs)
+    finally:
+        for output in outputs.values():
+            output.close()
+
+    vocab = {
+        lang: lang_vocab.trim(VOCAB_MIN_FREQ, VOCAB_MAX_WORDS)
+        for lang, lang_vocab in create_vocabs(corpus_dir, langs).items()
+    }
+
+    for lang in langs:
+        write_indices(corpus_dir, lang, (
+            vocab[lang].encode(norm_msg)
+            for norm_msg in iter_normalized(corpus_dir, lang)
+        ), num_sentences)
+    write_test_rows(corpus_dir, Random(TEST_SPLIT_SEED).sample(
+        range(num_sentences), int(TEST_SPLIT * num_sentences)))
+    build_memory(corpus_dir, filename, langs, num_sentences)
+
+    save_corpus_meta(corpus_dir, filename, max_size, langs, vocab,
+                     num_sentences, max_length, corpus_settings())
+    print(f"preprocessed {num_sentences} lines into {corpus_dir}")
 
-    dataset = []
-    with open(filename, "r") as file:
-        datum = file.readline()
-        i = 0
-        while i < MAX_DATASET_SIZE and datum:
-            datum = datum.split('\t')
-            if len(datum[0]) > max_length:
-                max_length = len(datum[0])
-            if len(datum[1]) > max_length:
-                max_length = len(datum[1])
 
-            dataset.append({
-                src_lang: normalize(datum[0], src_lang),
-                tgt_lang: normalize(datum[1], tgt_lang)
-            })
+def corpus_settings():
+    """
+    Settings baked into a preprocessed corpus, a change forces a rebuild.
+    """
+    return {
+        "vocab_min_freq": VOCAB_MIN_FREQ,
+        "vocab_max_words": VOCAB_MAX_WORDS,
+        "tokenizer": TOKENIZER,
+        "bpe_merges": BPE_MERGES if TOKENIZER == "bpe" else None,
+        "test_split": TEST_SPLIT,
+    }
+
 
-            if i % 10000 == 0:
-                print(f"{i} lines processed.")
+def get_corpus(filename=DATASET_FILE, corpus_dir=CORPUS_DIR,
+               max_size=MAX_DATASET_SIZE):
+    """
+    Opens the preprocessed corpus, building it first if it is missing or
+    was built from a different file.
 
-            datum = file.readline()
-            i += 1
-    return dataset
+    :return: corpus from load_corpus
+    """
+    if not corpus_is_fresh(corpus_dir, filename, max_size, corpus_settings()):
+        print(f"preprocessing {filename}...")
+        preprocess_dataset(filename, SRC_LANG, TGT_LANG, corpus_dir, max_size)
+    return load_corpus(corpus_dir)
 
 
 def normalize(string, lang):
     """
     Normalizes string. Proper nouns stay capitalized.
+    Fast path for a single string, skips nlp.pipe's batching overhead.
 
     :param string: string to normalize
     :param lang: language of string
     :return: string
     """
-    doc = tokenizer[lang](string)
+    return normalize_doc(get_pipeline(lang)(string))
+
+
+def normalize_batch(strings, lang, batch_size=NORMALIZE_BATCH_SIZE,
+                    n_process=NORMALIZE_PROCESSES):
+    """
+    Normalizes many strings through nlp.pipe.
+
+    :param strings: strings to normalize
+    :param lang: language of strings
+    :param batch_size: number of strings spaCy processes at a time
+    :param n_process: number of processes spaCy spreads the batches over
+    :return: list of strings, in input order
+    """
+    if len(strings) == 1:
+        return [normalize(strings[0], lang)]
+
+    docs = get_pipeline(lang).pipe(
+        strings, batch_size=batch_size, n_process=n_process)
+    return [normalize_doc(doc) for doc in docs]
+
 
+def normalize_doc(doc):
+    """
+    :param doc: spaCy Doc
+    :return: string
+    """
     normalized = []
     for token in doc:
         if token.pos_ == "PROPN":
@@ -83,216 +239,715 @@ def normalize(string, lang):
     return " ".join(normalized)
 
 
-def get_lang_data(dataset, lang):
+def create_vocabs(corpus_dir, langs=LANGS):
     """
-    Yields iterable of specified language data.
+    Creates vocabulary for each of the langauges in the corpus,
+    streaming the normalized text. Each vocab gets its own TOKENIZER,
+    which encode uses too, so training and inference split text the
+    same way.
 
-    :param dataset: dataset obtained from load_dataset
-    :param lang: language code of desired data
-    :return: iterable
+    :param corpus_dir: directory of a corpus with normalized text written
+    :param langs: language codes to build vocabs for
+    :return: dictionary
     """
-    for datum in dataset:
-        yield datum[lang]
+    vocabs = {}
+    for lang in langs:
+        tokenizer = train_tokenizer(TOKENIZER, iter_normalized(corpus_dir, lang),
+                                    BPE_MERGES)
+        vocabs[lang] = Vocab(iter_normalized(corpus_dir, lang), lang, tokenizer)
+    return vocabs
 
 
-def create_vocabs(dataset):
+def convert_to_tensor(string, lang_vocab):
     """
-    Creates vocabulary for each of the langauges in the dataset.
+    Converts normalized string to tensor for model input.
 
-    :param dataset: dataset obtained from load_dataset
-    :return: dictionary
+    :param string: normalized string
+    :param lang_vocab: Vocab of the string's language
+    :return: (length, 1) tensor
     """
-    vocabs = {}
-    for lang in LANGS:
-        data_iter = get_lang_data(dataset, lang)
-        vocabs[lang] = Vocab(data_iter, lang)
-    return vocabs
+    return tensor(lang_vocab.encode(string), dtype=long,
+                  device=DEVICE).view(-1, 1)
 
 
-def convert_to_tensor(string, lang):
+def get_train_test(corpus):
     """
-    Converts dataset to tensor for model input.
+    Splits corpus into training set and testing set, holding out the rows
+    saved with the corpus.
 
-    :param dataset: dataset to convert
-    :param vocab: vocab of each lang
+    :param corpus: corpus from get_corpus
+    :return: training sentence numbers, testing sentence numbers
     """
-    indices = []
-    for word in string.split(" "):
-        try:
-            indices.append(vocab[lang].word2index[word])
-        except Exception:
-            continue
-    indices.append(EOS_TOKEN)
+    test = corpus["test"].tolist()
+    held_out = set(test)
+    train = [row for row in range(corpus["meta"]["num_sentences"])
+             if row not in held_out]
 
-    return tensor(indices, dtype=long,
-                  device=DEVICE).view(-1, 1)
+    return train, test
+
+
+def sentence_lengths(corpus, lang):
+    offsets = corpus["offsets"][lang]
+    return offsets[1:] - offsets[:-1]
+
+
+def batch_rows(corpus, rows, src_lang, batch_size):
+    """
+    Splits rows into mini-batches. Rows are shuffled, grouped into buckets
+    of BUCKET_BATCHES batches, and sorted by source length within each
+    bucket, so each batch holds similar lengths and wastes little on padding.
+
+    :param corpus: corpus from get_corpus
+    :param rows: sentence numbers
+    :param src_lang: input language
+    :param batch_size: sentences per batch
+    :return: list of sentence number lists
+    """
+    rows = list(rows)
+    shuffle(rows)
+    src_lengths = sentence_lengths(corpus, src_lang)
+
+    batches = []
+    bucket_size = batch_size * BUCKET_BATCHES
+    for start in range(0, len(rows), bucket_size):
+        bucket = sorted(rows[start:start + bucket_size],
+                        key=lambda i: src_lengths[i])
+        batches += [bucket[i:i + batch_size]
+                    for i in range(0, len(bucket), batch_size)]
+    shuffle(batches)
+    return batches
+
+
+def make_batch(corpus, batch, src_lang, tgt_lang, max_len):
+    """
+    Pads one mini-batch of sentences into tensors.
+
+    :param corpus: corpus from get_corpus
+    :param batch: sentence numbers
+    :param src_lang: input language
+    :param tgt_lang: target language
+    :param max_len: longest input the decoder can attend over, see
+        input_limit
+    :return: (inputs, input_lengths, targets, target_mask)
+    """
+    inputs = [corpus_tensor(corpus, src_lang, i).view(-1)[:max_len]
+              for i in batch]
+    targets = [corpus_tensor(corpus, tgt_lang, i).view(-1)
+               for i in batch]
+    target_lengths = tensor([target.size(0) for target in targets])
+    targets = pad_sequence(targets, padding_value=EOS_TOKEN)
+    target_mask = arange(targets.size(0)).unsqueeze(1) < target_lengths
+
+    return (pad_sequence(inputs, padding_value=EOS_TOKEN).to(DEVICE),
+            [input.size(0) for input in inputs],
+            targets.to(DEVICE),
+            target_mask.to(DEVICE))
 
 
-def convert_to_tensors(dataset):
+def input_limit(decoder):
     """
-    Converts dataset to tensor for model input in place.
+    :return: longest input decoder can attend over, None if unlimited
+    """
+    return decoder.max_len if decoder.attention == "location" else None
 
-    :param dataset: dataset to convert
-    :param vocab: vocab of each lang
+
+def output_limit(decoder, input_length):
+    """
+    :param input_length: input token count
+    :return: max decoding steps
     """
-    for lang in LANGS:
-        for datum in dataset:
-            datum[lang] = convert_to_tensor(datum[lang], lang)
+    if decoder.attention == "location":
+        return decoder.max_len
+    return OUTPUT_LENGTH_RATIO * input_length + OUTPUT_LENGTH_SLACK
 
 
-def get_train_test(dataset, split=.8):
+def attention_inputs(outputs, lengths, decoder):
     """
-    Splits dataset into training set and testing set.
+    Lays out encoder outputs for Decoder.step. Location attention needs
+    them padded to its fixed max_len, the other modes take them as they are.
 
-    :param dataset: dataset to split
-    :split: percent of data to go in training set
-    :return: tensor training set, tensor test set
+    :param outputs: (seq_len, batch, memory_size) from Encoder.encode
+    :param lengths: true input lengths
+    :return: (batch, src_len, memory_size) outputs, (batch, src_len) mask
+        of real positions
     """
-    convert_to_tensors(dataset)
+    outputs = outputs.transpose(0, 1)
+    if decoder.attention == "location":
+        outputs = pad(outputs, (0, 0, 0, decoder.max_len - outputs.size(1)))
+    mask = arange(outputs.size(1), device=outputs.device).unsqueeze(0) \
+        < tensor(lengths, device=outputs.device).unsqueeze(1)
+    return outputs, mask
 
-    shuffle(dataset)    # shuffles in place
-    train_test_split = int(split * len(dataset))
-    train = dataset[:train_test_split]
-    test = dataset[train_test_split:]
 
-    return train, test
+def iter_batches(corpus, rows, src_lang, tgt_lang, batch_size, max_len):
+    """
+    Yields padded mini-batches, see batch_rows and make_batch.
 
+    :return: iterable of (inputs, input_lengths, targets, target_mask)
+    """
+    for batch in batch_rows(corpus, rows, src_lang, batch_size):
+        yield make_batch(corpus, batch, src_lang, tgt_lang, max_len)
 
-def train(input_tensor, target_tensor, encoder, decoder,
-          encoder_optimizer, decoder_optimizer, loss_fn):
-    memory = encoder.init_memory()
 
+def train_batch(inputs, input_lengths, targets, target_mask, encoder, decoder,
+                encoder_optimizer, decoder_optimizer, loss_fn,
+                teacher_forcing_ratio, grad_sync=None):
+    """
+    One optimizer step over a padded mini-batch. Whole sequences go through
+    the encoder GRU at once and the decoder advances every row per step.
+    Padding positions are masked out of the loss.
+    With a grad_sync the batch is this process's shard of a global batch:
+    the loss is normalized by the global token count and gradients are
+    summed across processes, so the step matches training on the whole
+    batch in one process.
+
+    :param inputs: (src_len, batch) padded input indices
+    :param input_lengths: true length of each input
+    :param targets: (tgt_len, batch) padded target indices
+    :param target_mask: (tgt_len, batch) True where targets are real tokens
+    :param teacher_forcing_ratio: chance of feeding the decoder the true
+        previous token rather than its own prediction, drawn per batch
+    :param grad_sync: GradientSync from nlp.parallel for data-parallel training
+    :return: summed loss tensor, number of target tokens
+    """
     encoder_optimizer.zero_grad()
     decoder_optimizer.zero_grad()
 
-    encoder_outputs = zeros(
-        decoder.max_len, encoder.memory_size, device=DEVICE)
+    outputs, memory = encoder.encode(inputs, input_lengths)
+    encoder_outputs, encoder_mask = attention_inputs(outputs, input_lengths, decoder)
 
+    teacher_forcing = random() < teacher_forcing_ratio
+    decoder_input = full((inputs.size(1),), SOS_TOKEN,
+                         dtype=long, device=DEVICE)
     loss = 0
-    for i in range(input_tensor.size(0)):
-        output, memory = encoder(input_tensor[i], memory)
-        encoder_outputs[i] = output[0, 0]
+    for i in range(targets.size(0)):
+        output, memory, _ = decoder.step(
+            decoder_input, memory, encoder_outputs, encoder_mask)
+        loss = loss + (loss_fn(output, targets[i]) * target_mask[i]).sum()
 
-    decoder_input = tensor([[SOS_TOKEN]], device=DEVICE)
-    for i in range(target_tensor.size(0)):
-        output, memory, _ = decoder(
-            decoder_input, memory, encoder_outputs)
-
-        _, topi = output.topk(1)
-        decoder_input = topi.squeeze().detach()
-
-        loss += loss_fn(output, target_tensor[i])
-        if decoder_input.item() == EOS_TOKEN:
-            break
+        if teacher_forcing:
+            decoder_input = targets[i]
+        else:
+            decoder_input = output.argmax(dim=1).detach()
 
-    loss.backward()
+    num_tokens = target_mask.sum()
+    if grad_sync is None:
+        (loss / num_tokens).backward()
+    else:
+        (loss / grad_sync.sum(num_tokens)).backward()
+        grad_sync.gradients()
 
     encoder_optimizer.step()
     decoder_optimizer.step()
 
-    return loss.item() / target_tensor.size(0)
+    return loss.detach(), num_tokens
 
 
-def train_iters(encoder: Encoder, decoder: Decoder, train_set, src_lang, tgt_lang, lr=0.1):
-    NUM_INTERVALS = 20
-    total_loss = 0
+def train_epochs(encoder: Encoder, decoder: Decoder, corpus, rows, src_lang, tgt_lang,
+                 epochs=TRAIN_EPOCHS, batch_size=TRAIN_BATCH_SIZE, lr=TRAIN_LR,
+                 teacher_forcing_ratio=TEACHER_FORCING_RATIO, grad_sync=None):
+    """
+    Trains an encoder/decoder pair on mini-batches for several epochs,
+    reporting loss and sentences per second after each.
+    With a grad_sync every process walks the same shuffled batches, seeded
+    alike, and trains on its rank's slice of each.
 
+    :param encoder: Encoder
+    :param decoder: Decoder
+    :param corpus: corpus from get_corpus
+    :param rows: training sentence numbers
+    :param epochs: passes over rows
+    :param batch_size: sentences per batch
+    :param lr: learning rate
+    :param teacher_forcing_ratio: see train_batch
+    :param grad_sync: GradientSync from nlp.parallel for data-parallel training
+    """
     encoder_optimizer = SGD(encoder.parameters(), lr=lr)
     decoder_optimizer = SGD(decoder.parameters(), lr=lr)
-    loss_fn = CrossEntropyLoss()
+    loss_fn = NLLLoss(reduction="none")
+
+    encoder.train()
+    decoder.train()
+    for epoch in range(epochs):
+        start = perf_counter()
+        total_loss = 0
+        total_tokens = 0
+        for batch in batch_rows(corpus, rows, src_lang, batch_size):
+            if grad_sync is not None:
+                batch = batch[grad_sync.rank::grad_sync.world_size]
+                if not batch:
+                    # keep the teacher forcing draws and collectives in step
+                    random()
+                    grad_sync.empty_step([encoder_optimizer, decoder_optimizer])
+                    continue
+
+            loss, num_tokens = train_batch(
+                *make_batch(corpus, batch, src_lang, tgt_lang, input_limit(decoder)),
+                encoder, decoder, encoder_optimizer, decoder_optimizer,
+                loss_fn, teacher_forcing_ratio, grad_sync)
+            total_loss += loss
+            total_tokens += num_tokens
+
+        if grad_sync is not None:
+            total_loss = grad_sync.sum(total_loss)
+            total_tokens = grad_sync.sum(total_tokens)
+            if grad_sync.rank != 0:
+                continue
+
+        # only sync with the device once per epoch
+        avg_loss = float(total_loss / total_tokens) if total_tokens else 0.0
+        elapsed = perf_counter() - start
+        print(f"{src_lang}->{tgt_lang} epoch {epoch + 1}/{epochs}: "
+              f"loss {avg_loss:.4f}, {len(rows) / elapsed:.1f} sentences/s")
+
+
+def train_model(model, corpus, train, src_lang, tgt_lang, **kwargs):
+    """
+    Trains seq2seq RNN model.
 
-    train_len = len(train_set)
-    for i in range(train_len):
-        input_tensor = train_set[i][src_lang]
-        target_tensor = train_set[i][tgt_lang]
+    :param model: {"encoder", "decoder"}
+    :param corpus: corpus from get_corpus
+    :param train: training sentence numbers
+    :param kwargs: overrides for train_epochs
+    """
+    train_epochs(model["encoder"], model["decoder"], corpus, train,
+                 src_lang, tgt_lang, **kwargs)
 
-        loss = train(input_tensor, target_tensor, encoder, decoder,
-                     encoder_optimizer, decoder_optimizer, loss_fn)
 
+def translate(string, encoder, decoder, src_lang, tgt_lang, **kwargs):
+    return translate_batch([string], encoder, decoder, src_lang, tgt_lang, **kwargs)[0]
 
-def train_model(model, train, src_lang, tgt_lang):
-    """
-    Trains seq2seq RNN model.
 
+def translate_batch(strings, encoder, decoder, src_lang, tgt_lang,
+                    beam_width=BEAM_WIDTH, length_penalty=LENGTH_PENALTY,
+                    vocab=None):
+    """
+    Translates many strings at once. Sentences found in translation_memory
+    get their reference translation and repeats come from
+    translation_cache, so only the distinct misses are decoded. A
+    beam_width of 1 decodes all misses greedily in one batch, wider beams
+    search each sentence. Translations are normalized word lists either
+    way, references as normalize left them in the corpus.
+
+    :param strings: strings to translate
     :param encoder: Encoder
     :param decoder: Decoder
-    :param train: training set
-    :lr: learning rate
+    :param src_lang: language of strings
+    :param tgt_lang: language to translate to
+    :param beam_width: hypotheses kept per sentence
+    :param length_penalty: see beam_search
+    :param vocab: vocabs of the pair, defaults to get_vocab
+    :return: list of translated word lists, in input order
     """
+    normalized = normalize_batch(strings, src_lang)
 
-    train_iters(model["encoder"], model["decoder"], train, src_lang, tgt_lang)
+    def cache_key(norm_msg):
+        return (norm_msg, src_lang, tgt_lang, beam_width, length_penalty)
 
+    translations = {}
+    misses = []
+    for norm_msg in normalized:
+        if norm_msg in translations:
+            continue
+        if translation_memory is not None:
+            reference = translation_memory.lookup(norm_msg, src_lang, tgt_lang)
+            if reference is not None:
+                translations[norm_msg] = reference.split()
+                continue
+        cached = translation_cache.get(cache_key(norm_msg))
+        translations[norm_msg] = cached
+        if cached is None:
+            misses.append(norm_msg)
+
+    if beam_width > 1:
+        decoded = [
+            beam_search(norm_msg, encoder, decoder, src_lang, tgt_lang,
+                        beam_width, length_penalty, vocab=vocab)
+            for norm_msg in misses
+        ]
+    else:
+        decoded = decode_batch(misses, encoder, decoder, src_lang, tgt_lang, vocab)
+    for norm_msg, translation in zip(misses, decoded):
+        translations[norm_msg] = translation
+        translation_cache.set(cache_key(norm_msg), translation)
+
+    return [list(translations[norm_msg]) for norm_msg in normalized]
+
+
+def length_normalize(score, length, length_penalty):
+    """
+    GNMT length penalty, so longer hypotheses aren't punished just for
+    summing more log probs. 0 disables it.
+    """
+    return score / (((5 + length) / 6) ** length_penalty)
 
-def translate(string, encoder, decoder, src_lang, tgt_lang):
-    with no_grad():
-        norm_msg = normalize(string, src_lang)
-        str_tensor = convert_to_tensor(norm_msg, src_lang)
-        memory = encoder.init_memory()
 
-        encoder_outputs = zeros(
-            decoder.max_len, encoder.memory_size, device=DEVICE)
+def beam_search(norm_msg, encoder, decoder, src_lang, tgt_lang,
+                beam_width=BEAM_WIDTH, length_penalty=LENGTH_PENALTY, max_len=None,
+                vocab=None):
+    """
+    Beam search decodes one normalized string. Every live hypothesis is a
+    row of one batch, so a single Decoder.step advances the whole beam.
+    Hypotheses leave the beam as soon as they emit EOS, and the search stops
+    once beam_width have finished and no live one can still beat them. Log
+    probs only fall as a hypothesis grows, so the best a live one can reach
+    is its current score normalized at whichever length in [i + 2, max_len]
+    the length penalty favors most.
+
+    :param norm_msg: string already passed through normalize
+    :param encoder: Encoder
+    :param decoder: Decoder
+    :param src_lang: language of norm_msg
+    :param tgt_lang: language to translate to
+    :param beam_width: hypotheses kept per step
+    :param length_penalty: exponent of the length penalty
+    :param max_len: max output tokens, defaults to output_limit
+    :param vocab: vocabs of the pair, defaults to get_vocab
+    :return: translated word list
+    """
+    vocab = vocab or get_vocab(src_lang, tgt_lang)
+    with no_grad():
+        str_tensor = convert_to_tensor(norm_msg, vocab[src_lang])[
+            :input_limit(decoder)]
+        max_len = max_len or output_limit(decoder, str_tensor.size(0))
+        outputs, memory = encoder.encode(str_tensor, [str_tensor.size(0)])
+        encoder_outputs, encoder_mask = attention_inputs(
+            outputs, [str_tensor.size(0)], decoder)
+
+        decoder_input = full((1,), SOS_TOKEN, dtype=long, device=DEVICE)
+        scores = zeros(1, device=DEVICE)
+        hypotheses = [[]]
+        finished = []
+        for i in range(max_len):
+            num_beams = decoder_input.size(0)
+            output, memory, _ = decoder.step(
+                decoder_input, memory,
+                encoder_outputs.expand(num_beams, -1, -1),
+                encoder_mask.expand(num_beams, -1))
+
+            vocab_size = output.size(1)
+            candidates = (scores.unsqueeze(1) + output).view(-1)
+            top_scores, top_indices = candidates.topk(
+                min(2 * beam_width, candidates.size(0)))
+
+            beams = []
+            tokens = []
+            beam_scores = []
+            for score, index in zip(top_scores.tolist(), top_indices.tolist()):
+                beam, token = divmod(index, vocab_size)
+                if token == EOS_TOKEN:
+                    finished.append((length_normalize(
+                        score, len(hypotheses[beam]) + 1, length_penalty),
+                        hypotheses[beam]))
+                    continue
+                beams.append(beam)
+                tokens.append(token)
+                beam_scores.append(score)
+                if len(beams) == beam_width:
+                    break
+
+            if not beams:
+                break
+            if len(finished) >= beam_width:
+                worst_kept = sorted(finished, reverse=True)[
+                    beam_width - 1][0]
+                best_live = max(
+                    length_normalize(beam_scores[0], length, length_penalty)
+                    for length in (i + 2, max_len))
+                if best_live <= worst_kept:
+                    break
+
+            hypotheses = [hypotheses[beam] + [token]
+                          for beam, token in zip(beams, tokens)]
+            beam_index = tensor(beams, dtype=long, device=DEVICE)
+            memory = memory[:, beam_index]
+            decoder_input = tensor(tokens, dtype=long, device=DEVICE)
+            scores = tensor(beam_scores, device=DEVICE)
+        else:
+            # ran out of steps, live hypotheses compete as they are
+            finished += [
+                (length_normalize(score, len(hypothesis), length_penalty), hypothesis)
+                for score, hypothesis in zip(scores.tolist(), hypotheses)
+            ]
 
-        for i in range(str_tensor.size(0)):
-            print(str_tensor[i])
-            output, memory = encoder(str_tensor[i], memory)
-            encoder_outputs[i] = output[0, 0]
+    best = max(finished, key=lambda hypothesis: hypothesis[0])[1]
+    return vocab[tgt_lang].decode(best)
 
-        translated_words = []
 
-        decoder_input = tensor([[SOS_TOKEN]], device=DEVICE)
-        for i in range(decoder.max_len):
-            output, memory, _ = decoder(
-                decoder_input, memory, encoder_outputs)
+def decode_batch(normalized, encoder, decoder, src_lang, tgt_lang, vocab=None):
+    """
+    Greedily decodes many normalized strings at once. The encoder runs over
+    the whole padded batch in one GRU call and the decoder advances every
+    row in lockstep, masking rows that have emitted EOS or reached their own
+    output_limit.
 
-            _, topi = output.topk(1)
+    :param normalized: strings already passed through normalize
+    :param encoder: Encoder
+    :param decoder: Decoder
+    :param src_lang: language of strings
+    :param tgt_lang: language to translate to
+    :param vocab: vocabs of the pair, defaults to get_vocab
+    :return: list of translated word lists, in input order
+    """
+    if not normalized:
+        return []
 
-            if topi.item() == EOS_TOKEN:
+    vocab = vocab or get_vocab(src_lang, tgt_lang)
+    with no_grad():
+        str_tensors = [
+            tensor(indices[:input_limit(decoder)], dtype=long, device=DEVICE)
+            for indices in vocab[src_lang].encode_batch(normalized)
+        ]
+        lengths = [str_tensor.size(0) for str_tensor in str_tensors]
+        inputs = pad_sequence(str_tensors, padding_value=EOS_TOKEN)
+
+        outputs, memory = encoder.encode(inputs, lengths)
+        encoder_outputs, encoder_mask = attention_inputs(outputs, lengths, decoder)
+
+        batch_size = len(normalized)
+
+        decoder_input = full((batch_size,), SOS_TOKEN,
+                             dtype=long, device=DEVICE)
+        finished = zeros(batch_size, dtype=torch_bool, device=DEVICE)
+        # each row stops at its own limit, so a sentence decodes the same
+        # whatever it's batched with
+        limits = tensor([output_limit(decoder, length) for length in lengths],
+                        device=DEVICE)
+        steps = []
+        for i in range(int(limits.max())):
+            output, memory, _ = decoder.step(
+                decoder_input, memory, encoder_outputs, encoder_mask)
+
+            topi = output.argmax(dim=1).masked_fill(finished, EOS_TOKEN)
+            steps.append(topi)
+
+            finished |= (topi == EOS_TOKEN) | (limits <= i + 1)
+            if finished.all():
                 break
-            else:
-                translated_words.append(
-                    vocab[tgt_lang].index2word[topi.item()])
+            decoder_input = topi
 
-            decoder_input = topi.squeeze().detach()
+        # single host sync for the whole batch
+        rows = stack(steps, dim=1).tolist()
 
-        return translated_words
+    return vocab[tgt_lang].decode_batch(rows)
 
 
-def init_model():
-    print("initializing machine translation models...")
+def get_pipeline(lang):
+    """
+    Gets the spaCy pipeline normalize uses for lang, loading it on first use.
+    Pipelines are shared by every pair out of a language and stay loaded.
 
-    global tokenizer
-    tokenizer = {
-        "en": load("en_core_web_sm"),
-        "es": load("es_core_news_sm"),
-    }
+    :param lang: language code
+    :return: spaCy Language
+    """
+    pipeline = tokenizer.get(lang)
+    if pipeline is not None:
+        return pipeline
 
-    dataset = load_dataset(DATASET_FILE, SRC_LANG, TGT_LANG)
+    with _tokenizer_lock:
+        if lang not in tokenizer:
+            start = perf_counter()
+            tokenizer[lang] = load(SPACY_MODELS.get(lang, f"{lang}_core_news_sm"),
+                                   exclude=UNUSED_PIPES)
+            print(f"loaded spaCy pipeline for {lang} in "
+                  f"{(perf_counter() - start) * 1000:.0f}ms")
+        return tokenizer[lang]
 
-    global vocab
-    vocab = create_vocabs(dataset)
 
-    train, test = get_train_test(dataset)
+def load_tokenizers(langs=LANGS):
+    """
+    Loads the spaCy pipelines of langs ahead of their first use.
+    """
+    for lang in langs:
+        get_pipeline(lang)
 
-    MEM_SIZE = 256
-    en2es = {
-        "encoder": Encoder(vocab[SRC_LANG].num_words, MEM_SIZE).to(DEVICE),
-        "decoder": Decoder(vocab[TGT_LANG].num_words, MEM_SIZE, max_len=max_length).to(DEVICE)
-    }
-    es2en = {
-        "encoder": Encoder(vocab[TGT_LANG].num_words, MEM_SIZE).to(DEVICE),
-        "decoder": Decoder(vocab[SRC_LANG].num_words, MEM_SIZE, max_len=max_length).to(DEVICE)
+
+def build_models(vocab, max_length, attention=ATTENTION):
+    """
+    Builds an untrained encoder/decoder pair for each translation direction.
+
+    :param vocab: vocab of each lang
+    :param max_length: max sentence length for location attention
+    :param attention: decoder attention mode
+    :return: nested dict of src -> tgt -> {"encoder", "decoder"}
+    """
+    return {
+        SRC_LANG: {TGT_LANG: build_model(vocab, max_length, SRC_LANG, TGT_LANG, attention)},
+        TGT_LANG: {SRC_LANG: build_model(vocab, max_length, TGT_LANG, SRC_LANG, attention)},
     }
 
-    global translator
-    translator = {
-        "en": {"es": en2es},
-        "es": {"en": es2en}
+
+def build_model(vocab, max_length, src_lang, tgt_lang, attention=ATTENTION):
+    """
+    Builds an untrained encoder/decoder pair for one translation direction.
+
+    :return: {"encoder", "decoder"}
+    """
+    return {
+        "encoder": Encoder(vocab[src_lang].num_words, MEM_SIZE).to(DEVICE),
+        "decoder": Decoder(vocab[tgt_lang].num_words, MEM_SIZE, max_len=max_length,
+                           attention=attention).to(DEVICE)
     }
 
+
+def train_models(max_size=MAX_DATASET_SIZE, **kwargs):
+    """
+    Trains both translation directions from the preprocessed corpus. They
+    are served once saved with save_artifact and picked up by load_models.
+
+    :param max_size: max number of dataset lines to train on, None for all
+    :param kwargs: overrides for train_epochs
+    :return: translator, vocab, max_length
+    """
+    corpus = get_corpus(max_size=max_size)
+
+    vocab = corpus["vocab"]
+    max_length = corpus["meta"]["max_length"]
+
+    train, test = get_train_test(corpus)
+
+    translator = build_models(vocab, max_length)
+
     print("training models...")
-    train_model(en2es, train, SRC_LANG, TGT_LANG)
-    train_model(es2en, train, TGT_LANG, SRC_LANG)
+    train_model(translator[SRC_LANG][TGT_LANG],
+                corpus, train, SRC_LANG, TGT_LANG, **kwargs)
+    train_model(translator[TGT_LANG][SRC_LANG],
+                corpus, train, TGT_LANG, SRC_LANG, **kwargs)
+
+    return translator, vocab, max_length
+
+
+def load_pair_models(artifact_dir, version, src_lang, tgt_lang, mode):
+    """
+    Loads one pair of an artifact for the registry, with the spaCy pipeline
+    its source language needs.
+
+    :param mode: "eager" for the fp32 weights or "optimized" for the
+        quantized TorchScript export
+    :return: {"encoder", "decoder", "vocab", "files"}
+    """
+    get_pipeline(src_lang)
+    artifact = load_pair(artifact_dir, version, src_lang, tgt_lang, map_location=DEVICE)
+    meta = artifact["meta"]
+
+    models = None
+    if mode == "optimized":
+        models = load_optimized([pair_name(src_lang, tgt_lang)], artifact_dir,
+                                version, map_location=DEVICE)
+        if models is None:
+            print(f"model artifact {version} has no optimized export of "
+                  f"{pair_name(src_lang, tgt_lang)}, falling back to eager models")
+        else:
+            models = models[src_lang][tgt_lang]
+
+    if models is None:
+        mode = "eager"
+        # artifacts from before attention modes all used location attention
+        models = build_model(artifact["vocab"], meta["max_length"], src_lang, tgt_lang,
+                             meta.get("attention", "location"))
+        for part in ["encoder", "decoder"]:
+            models[part].load_state_dict(artifact["state"][part])
+            models[part].eval()
+
+    return {
+        "encoder": models["encoder"],
+        "decoder": models["decoder"],
+        "vocab": artifact["vocab"],
+        "files": pair_files(artifact_dir, version, src_lang, tgt_lang,
+                            optimized=mode == "optimized"),
+    }
+
+
+# translation pairs served from disk, pointed at an artifact by load_models
+registry = ModelRegistry(load_pair_models)
+
+
+def load_models(artifact_dir=ARTIFACT_DIR, version=None, mode=None,
+                preload=MODEL_PRELOAD):
+    """
+    Serves the translation pairs saved in artifact_dir. Only the preload
+    pairs load now, the rest load on first use.
+
+    :param artifact_dir: root artifact directory
+    :param version: only serve this artifact version, defaults to every
+        pair on disk, see discover_pairs
+    :param mode: "eager" for the fp32 weights or "optimized" for the
+        quantized TorchScript export, defaults to INFERENCE_MODE
+    :param preload: list of (src, tgt) to load right away
+    :return: True if an artifact was found, False if none exists
+    """
+    mode = mode or INFERENCE_MODE
+    if not registry.open(artifact_dir, version, mode):
+        return False
+
+    global model_version
+    translation_cache.clear()
+    registry.preload(preload)
+    model_version = version or latest_version(artifact_dir)
+    print(f"serving {len(registry.available)} translation pairs from model "
+          f"artifact {model_version} ({mode})")
+    return True
+
+
+def init_model():
+    print("initializing machine translation models...")
+
+    if load_models():
+        load_translation_memory()
+        return
+
+    print(f"no model artifact found in {ARTIFACT_DIR}, training a small one on "
+          f"{BOOT_TRAIN_MAX_SIZE} sentences, run python -m nlp.train for a full model...")
+    save_artifact(*train_models(max_size=BOOT_TRAIN_MAX_SIZE,
+                                epochs=BOOT_TRAIN_EPOCHS), MEM_SIZE)
+    load_translation_memory()
+    # serves the new artifact like any other, model_ready reports True
+    # once it's in place
+    load_models()
+
+
+def load_translation_memory(corpus_dir=CORPUS_DIR):
+    """
+    Opens the corpus's translation memory for translate_batch to consult.
+    Serving without a preprocessed corpus, or with TRANSLATION_MEMORY=0,
+    leaves every sentence to the decoder.
+
+    :param corpus_dir: directory of a preprocessed corpus
+    :return: True if a memory was opened
+    """
+    global translation_memory
+    translation_memory = open_memory(corpus_dir) if TRANSLATION_MEMORY else None
+    if translation_memory is not None:
+        print(f"opened translation memory of "
+              f"{translation_memory.stats['sentences']} sentences")
+    return translation_memory is not None
+
+
+def translation_memory_stats():
+    """
+    :return: translation_memory's hit counters, None without a memory
+    """
+    return None if translation_memory is None else translation_memory.stats
+
+
+def model_ready():
+    """
+    :return: True once init_model or load_models has installed models
+    """
+    return model_version is not None
 
 
 def get_translator(src_lang, tgt_lang):
-    return translator[src_lang][tgt_lang]["encoder"], translator[src_lang][tgt_lang]["decoder"]
+    """
+    :return: encoder, decoder of the pair, loading it if needed
+    :raises ValueError: if no artifact has the pair
+    """
+    pair = registry.get(src_lang, tgt_lang)
+    return pair["encoder"], pair["decoder"]
+
+
+def get_vocab(src_lang, tgt_lang):
+    """
+    :return: dict of lang -> Vocab the pair's models were trained with
+    """
+    return registry.get(src_lang, tgt_lang)["vocab"]
@@ -0,0 +1,179 @@
+"""
+Multi-process training. Each translation direction trains in its own
+processes, and with data_parallel > 1 a direction is split across that many
+processes that all-reduce gradients over gloo after every batch.
+"""
+from multiprocessing import cpu_count, get_context
+from multiprocessing.connection import wait
+from os import getenv, path
+from random import randrange, seed as seed_random
+from tempfile import TemporaryDirectory
+from time import perf_counter
+
+from torch import (cat, float64, manual_seed, set_num_threads, tensor,
+                   zeros_like)
+from torch import load as torch_load
+from torch import save as torch_save
+from torch.distributed import (all_reduce, broadcast, destroy_process_group,
+                               init_process_group)
+
+import nlp.model as model
+
+# processes per translation direction, 1 trains each direction in one process
+TRAIN_DATA_PARALLEL = int(getenv("TRAIN_DATA_PARALLEL") or 1)
+
+
+class GradientSync:
+    """
+    Keeps the replicas of one model identical across data-parallel ranks:
+    the same initial weights, and after each batch the sum of every rank's
+    gradients in one flat all-reduce.
+    """
+
+    def __init__(self, modules, rank, world_size):
+        self.rank = rank
+        self.world_size = world_size
+        self.params = [param for module in modules for param in module.parameters()]
+
+    def broadcast_parameters(self):
+        for param in self.params:
+            broadcast(param.data, src=0)
+
+    def sum(self, value):
+        """
+        :param value: tensor or number
+        :return: value summed over all ranks, as a float64 tensor
+        """
+        total = value.detach().to(float64, copy=True) if hasattr(value, "detach") \
+            else tensor(float(value), dtype=float64)
+        all_reduce(total)
+        return total
+
+    def gradients(self):
+        for param in self.params:
+            if param.grad is None:
+                param.grad = zeros_like(param)
+        flat = cat([param.grad.view(-1) for param in self.params])
+        all_reduce(flat)
+
+        offset = 0
+        for param in self.params:
+            param.grad.copy_(flat[offset:offset + param.numel()].view_as(param))
+            offset += param.numel()
+
+    def empty_step(self, optimizers):
+        """
+        Takes part in a step this rank has no rows for, contributing no
+        tokens and zero gradients.
+        """
+        for optimizer in optimizers:
+            optimizer.zero_grad()
+        self.sum(0)
+        self.gradients()
+        for optimizer in optimizers:
+            optimizer.step()
+
+
+def _train_worker(src_lang, tgt_lang, rank, world_size, store_file, rows,
+                  seed, threads, state_file, kwargs):
+    """
+    Runs in a spawned process: trains one direction, or one rank's share of
+    it, and rank 0 saves the weights to state_file.
+    """
+    set_num_threads(threads)
+    # every rank of a direction draws the same shuffles and teacher forcing
+    seed_random(seed)
+    manual_seed(seed)
+
+    corpus = model.get_corpus()
+    pair = model.build_model(corpus["vocab"], corpus["meta"]["max_length"],
+                             src_lang, tgt_lang)
+
+    grad_sync = None
+    if world_size > 1:
+        init_process_group("gloo", init_method=f"file://{store_file}",
+                           rank=rank, world_size=world_size)
+        grad_sync = GradientSync([pair["encoder"], pair["decoder"]], rank, world_size)
+        grad_sync.broadcast_parameters()
+
+    model.train_epochs(pair["encoder"], pair["decoder"], corpus, rows,
+                       src_lang, tgt_lang, grad_sync=grad_sync, **kwargs)
+
+    if rank == 0:
+        torch_save({
+            "encoder": pair["encoder"].state_dict(),
+            "decoder": pair["decoder"].state_dict(),
+        }, state_file)
+    if grad_sync is not None:
+        destroy_process_group()
+
+
+def join_all(processes):
+    """
+    Waits for every process, stopping the rest as soon as one fails so
+    ranks blocked in an all-reduce don't hang forever.
+    """
+    running = list(processes)
+    while running:
+        for sentinel in wait([process.sentinel for process in running]):
+            process = next(p for p in running if p.sentinel == sentinel)
+            running.remove(process)
+            process.join()
+            if process.exitcode != 0:
+                for other in running:
+                    other.terminate()
+                raise RuntimeError(
+                    f"training process {process.name} exited with {process.exitcode}")
+
+
+def train_models_parallel(data_parallel=TRAIN_DATA_PARALLEL, threads=None,
+                          seed=None, **kwargs):
+    """
+    Trains both translation directions at once in separate processes, like
+    train_models.
+
+    :param data_parallel: processes per direction
+    :param threads: torch threads per process, defaults to an even split
+        of the cores
+    :param seed: random seed shared by the ranks of a direction
+    :param kwargs: overrides for train_epochs
+    :return: translator, vocab, max_length
+    """
+    # preprocess once here so the workers only map the cached arrays
+    corpus = model.get_corpus()
+    vocab = corpus["vocab"]
+    max_length = corpus["meta"]["max_length"]
+    train, test = model.get_train_test(corpus)
+
+    pairs = [(model.SRC_LANG, model.TGT_LANG), (model.TGT_LANG, model.SRC_LANG)]
+    num_processes = len(pairs) * data_parallel
+    threads = threads or max(cpu_count() // num_processes, 1)
+    seed = randrange(2 ** 31) if seed is None else seed
+
+    print(f"training models in {num_processes} processes "
+          f"({data_parallel} per direction, {threads} threads each)...")
+    start = perf_counter()
+    context = get_context("spawn")
+    with TemporaryDirectory() as tmp_dir:
+        processes = []
+        for src_lang, tgt_lang in pairs:
+            name = f"{src_lang}-{tgt_lang}"
+            for rank in range(data_parallel):
+                process = context.Process(
+                    name=f"{name}/{rank}", target=_train_worker, args=(
+                        src_lang, tgt_lang, rank, data_parallel,
+                        path.join(tmp_dir, f"{name}.store"), train, seed,
+                        threads, path.join(tmp_dir, f"{name}.pt"), kwargs))
+                process.start()
+                processes.append(process)
+        join_all(processes)
+
+        translator = model.build_models(vocab, max_length)
+        for src_lang, tgt_lang in pairs:
+            state = torch_load(path.join(tmp_dir, f"{src_lang}-{tgt_lang}.pt"),
+                               map_location=model.DEVICE)
+            for part in ["encoder", "decoder"]:
+                translator[src_lang][tgt_lang][part].load_state_dict(state[part])
+
+    print(f"trained models in {perf_counter() - start:.1f}s")
+    return translator, vocab, max_length
@@ -0,0 +1,160 @@
+"""
+Registry of the translation pairs on disk. Pairs load on first use and the
+least recently used ones are evicted once the resident models outgrow the
+memory budget, so adding languages doesn't add to startup time or to every
+process's memory.
+"""
+from collections import OrderedDict
+from os import getenv, path
+from threading import Lock
+from time import perf_counter
+
+from nlp.artifact import ARTIFACT_DIR, discover_pairs, pair_name
+
+# MB of model files kept resident per process, 0 for no limit
+MODEL_MEMORY_BUDGET_MB = float(getenv("MODEL_MEMORY_BUDGET_MB") or 0)
+
+
+class ModelRegistry:
+    """
+    Lazily loaded, LRU evicted translation pairs. A pair's size is
+    estimated from its files on disk. The pair just loaded is never
+    evicted, so one pair larger than the budget still gets served.
+    """
+
+    def __init__(self, load_pair, budget_mb=MODEL_MEMORY_BUDGET_MB):
+        """
+        :param load_pair: called as load_pair(artifact_dir, version, src_lang,
+            tgt_lang, mode), returns {"encoder", "decoder", "vocab", "files"}
+        :param budget_mb: MB of resident models before evicting, 0 for no limit
+        """
+        self.load_pair = load_pair
+        self.budget = budget_mb * 2 ** 20
+
+        self.artifact_dir = ARTIFACT_DIR
+        self.mode = None
+        # (src, tgt) -> artifact version, set by open
+        self.available = {}
+        # (src, tgt) -> entry, least recently used first
+        self._resident = OrderedDict()
+        self._loading = {}
+        self._lock = Lock()
+
+        self.hits = 0
+        self.loads = 0
+        self.load_time = 0.0
+        self.evictions = 0
+
+    def open(self, artifact_dir, version=None, mode=None):
+        """
+        Points the registry at the pairs saved in artifact_dir, dropping any
+        loaded from before.
+
+        :param artifact_dir: root artifact directory
+        :param version: only serve this artifact version
+        :param mode: passed to load_pair
+        :return: number of pairs found
+        """
+        available = discover_pairs(artifact_dir, version)
+        with self._lock:
+            self.artifact_dir = artifact_dir
+            self.mode = mode
+            self.available = available
+            self._resident.clear()
+            self._loading.clear()
+        return len(available)
+
+    def get(self, src_lang, tgt_lang):
+        """
+        :return: resident entry of the pair, loading it if needed
+        """
+        key = (src_lang, tgt_lang)
+        with self._lock:
+            entry = self._touch(key)
+            if entry is not None:
+                return entry
+            if key not in self.available:
+                raise ValueError(f"No translation model for {pair_name(*key)}")
+            version = self.available[key]
+            loading = self._loading.setdefault(key, Lock())
+
+        # one thread loads a pair while lookups of other pairs carry on
+        with loading:
+            with self._lock:
+                entry = self._touch(key)
+            if entry is not None:
+                return entry
+
+            start = perf_counter()
+            entry = self.load_pair(self.artifact_dir, version, src_lang, tgt_lang,
+                                   self.mode)
+            entry["version"] = version
+            entry["bytes"] = sum(path.getsize(file) for file in entry.pop("files"))
+            entry["load_time"] = perf_counter() - start
+            print(f"loaded translation model {pair_name(*key)} ({version}) "
+                  f"in {entry['load_time'] * 1000:.0f}ms")
+
+            with self._lock:
+                self.loads += 1
+                self.load_time += entry["load_time"]
+                # unless open pointed the registry elsewhere meanwhile
+                if self.available.get(key) == version:
+                    self._resident[key] = entry
+                    self._evict(keep=key)
+        return entry
+
+    def preload(self, pairs):
+        """
+        Loads pairs ahead of their first use, skipping ones not on disk.
+
+        :param pairs: iterable of (src, tgt)
+        """
+        for key in pairs:
+            if key in self.available:
+                self.get(*key)
+
+    def _touch(self, key):
+        entry = self._resident.get(key)
+        if entry is not None:
+            self._resident.move_to_end(key)
+            self.hits += 1
+        return entry
+
+    def resident_bytes(self):
+        return sum(entry["bytes"] for entry in self._resident.values())
+
+    def _evict(self, keep):
+        """
+        Drops least recently used pairs until the budget fits.
+        Call with the lock held.
+        """
+        while self.budget and self.resident_bytes() > self.budget:
+            oldest = next(iter(self._resident))
+            if oldest == keep:
+                break
+            del self._resident[oldest]
+            self.evictions += 1
+            print(f"evicted translation model {pair_name(*oldest)}")
+
+    @property
+    def stats(self):
+        """
+        :return: resident models and load counters for /stats
+        """
+        with self._lock:
+            return {
+                "mode": self.mode,
+                "budget_mb": self.budget / 2 ** 20,
+                "resident_mb": round(self.resident_bytes() / 2 ** 20, 3),
+                "available": sorted(pair_name(*key) for key in self.available),
+                "resident": [{
+                    "pair": pair_name(*key),
+                    "version": entry["version"],
+                    "mb": round(entry["bytes"] / 2 ** 20, 3),
+                    "load_ms": round(entry["load_time"] * 1000, 3),
+                } for key, entry in reversed(list(self._resident.items()))],
+                "hits": self.hits,
+                "loads": self.loads,
+                "evictions": self.evictions,
+                "mean_load_ms": self.load_time / self.loads * 1000 if self.loads else 0.0,
+            }
@@ -1,11 +1,18 @@
-from torch import bmm, cat, device, zeros
+from typing import List, Tuple
+
+from torch import Tensor, bmm, cat, device, jit, ones, tensor, zeros
 from torch.cuda import is_available as cuda_is_available
 from torch.cuda import memory
-from torch.nn import GRU, Dropout, Embedding, Linear, Module
+from torch.nn import GRU, Dropout, Embedding, Identity, Linear, Module
 from torch.nn.functional import log_softmax, relu, softmax
+from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence
 
 DEVICE = device("cuda" if cuda_is_available() else "cpu")
 
+# "location" scores a fixed max_len slots from the decoder state alone,
+# "dot" and "general" score the real encoder outputs against the memory
+ATTENTION_MODES = ["location", "dot", "general"]
+
 
 class Encoder(Module):
     def __init__(self, input_size, memory_size):
@@ -19,38 +26,93 @@ class Encoder(Module):
         output = self.embedding(input).view(1, 1, -1)
         return self.gru(output, memory)
 
+    @jit.export
+    def encode(self, inputs: Tensor, lengths: List[int]) -> Tuple[Tensor, Tensor]:
+        """
+        Runs the whole padded batch through the GRU in one call.
+
+        :param inputs: (seq_len, batch) padded index tensor
+        :param lengths: true length of each column
+        :return: (seq_len, batch, memory_size) outputs zeroed past each
+            length, (1, batch, memory_size) final memory
+        """
+        embedded = self.embedding(inputs)
+        packed = pack_padded_sequence(
+            embedded, tensor(lengths), enforce_sorted=False)
+        outputs, memory = self.gru(packed)
+        outputs, _ = pad_packed_sequence(outputs)
+        return outputs, memory
+
     def init_memory(self):
         return zeros(1, 1, self.memory_size, device=DEVICE)
 
 
 class Decoder(Module):
-    def __init__(self, output_size, memory_size, dropout=0.1, max_len=50):
+    def __init__(self, output_size, memory_size, dropout=0.1, max_len=50,
+                 attention="location"):
+        """
+        :param max_len: attention slots for location attention. The other
+            modes attend over however many encoder outputs there are, and
+            max_len only caps how long inputs to location decoders get
+        :param attention: one of ATTENTION_MODES
+        """
         super(Decoder, self).__init__()
+        if attention not in ATTENTION_MODES:
+            raise ValueError(f"Unknown attention mode '{attention}'")
         self.max_len = max_len
+        self.attention = attention
 
         self.memory_size = memory_size
 
         self.embedding = Embedding(output_size, memory_size)
         self.dropout = Dropout(dropout)
 
-        self.attn = Linear(memory_size * 2, max_len)
+        if attention == "location":
+            self.attn = Linear(memory_size * 2, max_len)
+        elif attention == "general":
+            self.attn = Linear(memory_size, memory_size, bias=False)
+        else:
+            self.attn = Identity()
         self.attn_combine = Linear(memory_size * 2, memory_size)
 
         self.gru = GRU(memory_size, memory_size)
         self.output = Linear(memory_size, output_size)
 
     def forward(self, input, memory, encoder_outputs):
-        output = self.embedding(input).view(1, 1, -1)
+        encoder_outputs = encoder_outputs.unsqueeze(0)
+        mask = ones(encoder_outputs.size(0), encoder_outputs.size(1),
+                    device=encoder_outputs.device) > 0
+        return self.step(input.view(-1), memory, encoder_outputs, mask)
+
+    @jit.export
+    def step(self, input: Tensor, memory: Tensor, encoder_outputs: Tensor,
+             encoder_mask: Tensor) -> Tuple[Tensor, Tensor, Tensor]:
+        """
+        Advances every row of a batch by one token.
+
+        :param input: (batch,) previous token indices
+        :param memory: (1, batch, memory_size)
+        :param encoder_outputs: (batch, src_len, memory_size), src_len is
+            max_len for location attention
+        :param encoder_mask: (batch, src_len) True at real encoder outputs,
+            ignored by location attention
+        :return: (batch, output_size) log probs, memory, attn weights
+        """
+        output = self.embedding(input)
         output = self.dropout(output)
 
         # calculate attn weights
-        attn_weights = softmax(
-            self.attn(cat((output[0], memory[0]), 1)), dim=1)
-        attn_applied = bmm(attn_weights.unsqueeze(0),
-                           encoder_outputs.unsqueeze(0))
+        if self.attention == "location":
+            scores = self.attn(cat((output, memory[0]), 1))
+        else:
+            # cost grows with the real input length, padding is masked out
+            scores = bmm(encoder_outputs, self.attn(memory[0]).unsqueeze(2))[:, :, 0]
+            scores = scores.masked_fill(~encoder_mask, float("-inf"))
+        attn_weights = softmax(scores, dim=1)
+        attn_applied = bmm(attn_weights.unsqueeze(1), encoder_outputs)
 
         # apply attn weights
-        output = cat((output[0], attn_applied[0]), 1)
+        output = cat((output, attn_applied[:, 0]), 1)
         output = self.attn_combine(output).unsqueeze(0)
 
         output = relu(output)
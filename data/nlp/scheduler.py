@@ -0,0 +1,213 @@
+from collections import Counter, OrderedDict
+from concurrent.futures import Future
+from os import getenv, getpid
+from threading import Condition, Lock, Thread
+from time import monotonic
+
+# how long the first request of a batch waits for company, and how many
+# distinct strings a batch takes before it's sent without waiting
+BATCH_WINDOW_MS = float(getenv("TRANSLATION_BATCH_WINDOW_MS") or 5)
+MAX_BATCH_SIZE = int(getenv("TRANSLATION_MAX_BATCH_SIZE") or 64)
+
+
+def histogram_bucket(value):
+    """
+    :return: smallest power of two >= value, as a JSON key
+    """
+    bucket = 1
+    while bucket < value:
+        bucket *= 2
+    return str(bucket)
+
+
+def gather(futures):
+    """
+    :param futures: list of Futures, may repeat
+    :return: Future resolving to the list of their results, or to the
+        first exception once all are done
+    """
+    combined = Future()
+    if not futures:
+        combined.set_result([])
+        return combined
+
+    remaining = [len(futures)]
+    lock = Lock()
+
+    def done(_):
+        with lock:
+            remaining[0] -= 1
+            if remaining[0]:
+                return
+        for future in futures:
+            if future.exception() is not None:
+                combined.set_exception(future.exception())
+                return
+        combined.set_result([future.result() for future in futures])
+
+    for future in futures:
+        future.add_done_callback(done)
+    return combined
+
+
+class MicroBatcher:
+    """
+    Collects translation requests from concurrent callers into one batch
+    per (src, tgt) pair. A batch is sent once its oldest request has waited
+    window_ms or it holds max_batch_size distinct strings. Requests for a
+    string that is already queued or being translated share its Future.
+    """
+
+    def __init__(self, run_batch, window_ms=BATCH_WINDOW_MS,
+                 max_batch_size=MAX_BATCH_SIZE):
+        """
+        :param run_batch: called as run_batch(contents, src_lang, tgt_lang)
+            from the scheduler thread, returns a Future resolving to the
+            list of translations
+        :param window_ms: max milliseconds a request waits for a batch to fill
+        :param max_batch_size: max distinct strings per batch
+        """
+        self.run_batch = run_batch
+        self.window = window_ms / 1000
+        self.max_batch_size = max_batch_size
+
+        self._cond = Condition()
+        # (src, tgt) -> OrderedDict of content -> Future, oldest first
+        self._queues = {}
+        # (src, tgt) -> monotonic time the oldest queued request arrived
+        self._opened = {}
+        # (content, src, tgt) -> Future for strings sent but not finished
+        self._in_flight = {}
+        self._thread_pid = None
+
+        self.requests = 0
+        self.coalesced = 0
+        self.batches = 0
+        self.batched = 0
+        self.queue_depth = Counter()
+        self.batch_size = Counter()
+
+    def submit(self, content, src_lang, tgt_lang):
+        """
+        :return: Future resolving to the translated string
+        """
+        pair = (src_lang, tgt_lang)
+        with self._cond:
+            self._ensure_thread()
+            self.requests += 1
+            queue = self._queues.setdefault(pair, OrderedDict())
+            future = queue.get(content) or self._in_flight.get((content, *pair))
+            if future is not None:
+                self.coalesced += 1
+                return future
+
+            future = Future()
+            if not queue:
+                self._opened[pair] = monotonic()
+            queue[content] = future
+            self.queue_depth[histogram_bucket(self.depth())] += 1
+            self._cond.notify()
+            return future
+
+    def submit_many(self, contents, src_lang, tgt_lang):
+        """
+        :return: Future resolving to the list of translated strings
+        """
+        return gather([self.submit(content, src_lang, tgt_lang)
+                       for content in contents])
+
+    def depth(self):
+        return sum(len(queue) for queue in self._queues.values())
+
+    def _ensure_thread(self):
+        # started lazily so each forked server process runs its own
+        if self._thread_pid != getpid():
+            self._queues.clear()
+            self._opened.clear()
+            self._in_flight.clear()
+            Thread(target=self._loop, name="translation-scheduler",
+                   daemon=True).start()
+            self._thread_pid = getpid()
+
+    def _take_ready(self):
+        """
+        Pops every batch that is full or has waited out the window.
+        Call with the lock held.
+
+        :return: list of (pair, OrderedDict), seconds until the next batch
+            is due or None if nothing is queued
+        """
+        now = monotonic()
+        ready = []
+        next_due = None
+        for pair, queue in self._queues.items():
+            if not queue:
+                continue
+            due = self._opened[pair] + self.window
+            if len(queue) < self.max_batch_size and due > now:
+                next_due = due - now if next_due is None else min(next_due, due - now)
+                continue
+
+            batch = OrderedDict()
+            while queue and len(batch) < self.max_batch_size:
+                content, future = queue.popitem(last=False)
+                batch[content] = future
+                self._in_flight[(content, *pair)] = future
+            if queue:
+                self._opened[pair] = now
+            ready.append((pair, batch))
+        return ready, next_due
+
+    def _loop(self):
+        while True:
+            with self._cond:
+                ready, next_due = self._take_ready()
+                while not ready:
+                    self._cond.wait(next_due)
+                    ready, next_due = self._take_ready()
+                for _, batch in ready:
+                    self.batches += 1
+                    self.batched += len(batch)
+                    self.batch_size[histogram_bucket(len(batch))] += 1
+
+            for pair, batch in ready:
+                self._dispatch(pair, batch)
+
+    def _dispatch(self, pair, batch):
+        contents = list(batch.keys())
+        try:
+            result = self.run_batch(contents, *pair)
+        except Exception as e:
+            result = Future()
+            result.set_exception(e)
+
+        def deliver(done):
+            with self._cond:
+                for content in contents:
+                    self._in_flight.pop((content, *pair), None)
+            if done.exception() is not None:
+                for future in batch.values():
+                    future.set_exception(done.exception())
+                return
+            for future, translation in zip(batch.values(), done.result()):
+                future.set_result(translation)
+
+        result.add_done_callback(deliver)
+
+    @property
+    def stats(self):
+        """
+        :return: scheduler counters and histograms for /stats
+        """
+        with self._cond:
+            return {
+                "window_ms": self.window * 1000,
+                "max_batch_size": self.max_batch_size,
+                "queue_depth_now": self.depth(),
+                "requests": self.requests,
+                "coalesced": self.coalesced,
+                "batches": self.batches,
+                "mean_batch_size": self.batched / self.batches if self.batches else 0.0,
+                "queue_depth": dict(self.queue_depth),
+                "batch_size": dict(self.batch_size),
+            }
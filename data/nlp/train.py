@@ -0,0 +1,50 @@
+"""
+Offline training entry point. Trains both translation directions and saves
+them as a model artifact that init_model loads on startup.
+
+Run from the data directory:
+    python -m nlp.train [--epochs N] [--batch-size N] [--lr LR] [--teacher-forcing RATIO]
+        [--parallel] [--data-parallel N] [--threads N] [--seed N]
+
+--parallel trains the two directions concurrently in separate processes,
+--data-parallel N also splits each direction across N processes.
+"""
+from argparse import ArgumentParser
+
+from nlp.artifact import ARTIFACT_DIR, save_artifact
+from nlp.model import (MEM_SIZE, TEACHER_FORCING_RATIO, TRAIN_BATCH_SIZE,
+                       TRAIN_EPOCHS, TRAIN_LR, load_tokenizers, train_models)
+from nlp.parallel import TRAIN_DATA_PARALLEL, train_models_parallel
+
+
+def main():
+    parser = ArgumentParser(description="Train translation models offline.")
+    parser.add_argument("--epochs", type=int, default=TRAIN_EPOCHS)
+    parser.add_argument("--batch-size", type=int, default=TRAIN_BATCH_SIZE)
+    parser.add_argument("--lr", type=float, default=TRAIN_LR)
+    parser.add_argument("--teacher-forcing", type=float,
+                        default=TEACHER_FORCING_RATIO)
+    parser.add_argument("--parallel", action="store_true")
+    parser.add_argument("--data-parallel", type=int, default=TRAIN_DATA_PARALLEL)
+    parser.add_argument("--threads", type=int, default=None,
+                        help="torch threads per training process")
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+
+    load_tokenizers()
+    kwargs = {
+        "epochs": args.epochs,
+        "batch_size": args.batch_size,
+        "lr": args.lr,
+        "teacher_forcing_ratio": args.teacher_forcing,
+    }
+    if args.parallel or args.data_parallel > 1:
+        translator, vocab, max_length = train_models_parallel(
+            args.data_parallel, args.threads, args.seed, **kwargs)
+    else:
+        translator, vocab, max_length = train_models(**kwargs)
+    save_artifact(translator, vocab, max_length, MEM_SIZE, ARTIFACT_DIR)
+
+
+if __name__ == "__main__":
+    main()
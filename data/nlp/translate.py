@@ -1,18 +1,59 @@
-from nlp.model import get_translator, translate
+from time import monotonic
 
+import db.handlers.translation_handler as translation_handler
+from db.models import TRANSLATION_DONE, TRANSLATION_PENDING
+from db.sqlalchemy_db import end_transaction
+from nlp.jobs import TRANSLATION_TIMEOUT, await_translations, submit_translations
 
-def translate_conversation(convo: "list[str]", src_lang: str, tgt_lang: str):
-    translated = []
-    encoder, decoder = get_translator(src_lang, tgt_lang)
-    for i, msg in enumerate(convo):
-        if msg["lang"] == tgt_lang:  # no need to translate
-            translated.append(msg)
-            continue
 
-        translation = translate(
-            msg["message_content"], encoder, decoder, src_lang, tgt_lang)
+def translate_stored_conversation(convo: "list[dict]", tgt_lang: str,
+                                  timeout: float = TRANSLATION_TIMEOUT):
+    """
+    Translates a conversation using translations stored at send time.
+    Messages still pending are sent to the translation workers, one job per
+    language they were written in; any not finished within timeout, or
+    whose job failed, keep their original text and are marked pending.
 
-        translated.append(msg)
-        translated[i]["message_content"] = " ".join(translation)
+    :param convo: serialized messages
+    :param tgt_lang: language to translate to
+    :param timeout: seconds to wait on the workers
+    :return: convo with message_content translated in place
+    """
+    foreign = [msg for msg in convo if msg["lang"] != tgt_lang]
+    stored = translation_handler.get_translations(
+        [msg["id"] for msg in foreign], tgt_lang)
 
-    return translated
+    # src lang -> messages
+    pending = {}
+    for msg in foreign:
+        translation = stored.get(msg["id"])
+        if translation and translation["status"] == TRANSLATION_DONE:
+            msg["message_content"] = translation["translated_content"]
+            msg["translation_status"] = TRANSLATION_DONE
+        else:
+            pending.setdefault(msg["lang"], []).append(msg)
+
+    # don't hold the request's connection while the workers translate
+    if pending:
+        end_transaction()
+
+    # submit every language before waiting, so they translate concurrently
+    futures = {
+        src_lang: submit_translations(
+            [msg["id"] for msg in group],
+            [msg["message_content"] for msg in group],
+            src_lang, tgt_lang)
+        for src_lang, group in pending.items()
+    }
+    deadline = monotonic() + timeout
+    for src_lang, group in pending.items():
+        translations = await_translations(futures[src_lang],
+                                          max(deadline - monotonic(), 0))
+        for i, msg in enumerate(group):
+            if translations is None:
+                msg["translation_status"] = TRANSLATION_PENDING
+            else:
+                msg["message_content"] = translations[i]
+                msg["translation_status"] = TRANSLATION_DONE
+
+    return convo
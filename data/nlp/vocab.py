@@ -1,31 +1,290 @@
-from nltk import sent_tokenize, word_tokenize
+from collections import Counter, defaultdict
+from heapq import heapify, heappop, heappush
 
 SOS_TOKEN = 0
 EOS_TOKEN = 1
+UNK_TOKEN = 2
+SPECIAL_WORDS = ["SOS", "EOS", "UNK"]
+
+
+class WhitespaceTokenizer:
+    """
+    Splits normalized text on whitespace, one token per word.
+    """
+    name = "whitespace"
+
+    def tokenize(self, sentence):
+        return sentence.split()
+
+    def detokenize(self, tokens):
+        return list(tokens)
+
+    def to_dict(self):
+        return {"type": self.name}
+
+
+class BPETokenizer:
+    """
+    Byte-pair encoding learned from the corpus. Frequent words stay whole
+    and rare ones split into subwords, so a small vocab still covers the
+    text and the output softmax stays cheap.
+    """
+    name = "bpe"
+    END = "</w>"
+
+    def __init__(self, merges=()):
+        self.merges = [tuple(merge) for merge in merges]
+        self.ranks = {merge: rank for rank, merge in enumerate(self.merges)}
+        self._cache = {}
+
+    @classmethod
+    def train(cls, data_iter, num_merges):
+        """
+        Learns merges from normalized sentences, keeping pair counts in a
+        heap so each merge only touches the words containing it.
+
+        :param data_iter: iterable of normalized sentences
+        :param num_merges: max number of merges to learn
+        :return: BPETokenizer
+        """
+        word_freq = Counter()
+        for datum in data_iter:
+            word_freq.update(datum.split())
+
+        words = [cls.symbols(word) for word in word_freq]
+        freqs = list(word_freq.values())
+        pair_counts = Counter()
+        pair_words = defaultdict(set)
+        for i, symbols in enumerate(words):
+            for pair in zip(symbols, symbols[1:]):
+                pair_counts[pair] += freqs[i]
+                pair_words[pair].add(i)
+
+        heap = [(-count, pair) for pair, count in pair_counts.items()]
+        heapify(heap)
+        merges = []
+        while heap and len(merges) < num_merges:
+            count, pair = heappop(heap)
+            if -count != pair_counts.get(pair, 0) or count == 0:
+                continue    # stale entry
+            merges.append(pair)
+
+            changed = Counter()
+            for i in pair_words.pop(pair):
+                old = words[i]
+                new = cls.merge(old, pair)
+                for old_pair in zip(old, old[1:]):
+                    changed[old_pair] -= freqs[i]
+                for new_pair in zip(new, new[1:]):
+                    changed[new_pair] += freqs[i]
+                    pair_words[new_pair].add(i)
+                words[i] = new
+            pair_counts.pop(pair, None)
+
+            for changed_pair, delta in changed.items():
+                if delta == 0 or changed_pair == pair:
+                    continue
+                pair_counts[changed_pair] += delta
+                if pair_counts[changed_pair] > 0:
+                    heappush(heap, (-pair_counts[changed_pair], changed_pair))
+                else:
+                    del pair_counts[changed_pair]
+
+        return cls(merges)
+
+    @classmethod
+    def symbols(cls, word):
+        return tuple(word[:-1]) + (word[-1] + cls.END,)
+
+    @staticmethod
+    def merge(symbols, pair):
+        merged = []
+        i = 0
+        while i < len(symbols):
+            if i < len(symbols) - 1 and (symbols[i], symbols[i + 1]) == pair:
+                merged.append(symbols[i] + symbols[i + 1])
+                i += 2
+            else:
+                merged.append(symbols[i])
+                i += 1
+        return tuple(merged)
+
+    def tokenize_word(self, word):
+        tokens = self._cache.get(word)
+        if tokens is not None:
+            return tokens
+
+        symbols = self.symbols(word)
+        while len(symbols) > 1:
+            pair = min(zip(symbols, symbols[1:]),
+                       key=lambda pair: self.ranks.get(pair, len(self.ranks)))
+            if pair not in self.ranks:
+                break
+            symbols = self.merge(symbols, pair)
+
+        self._cache[word] = symbols
+        return symbols
+
+    def tokenize(self, sentence):
+        tokens = []
+        for word in sentence.split():
+            tokens.extend(self.tokenize_word(word))
+        return tokens
+
+    def detokenize(self, tokens):
+        words = "".join(tokens).split(self.END)
+        return [word for word in words if word]
+
+    def to_dict(self):
+        return {"type": self.name, "merges": self.merges}
+
+
+def load_tokenizer(data):
+    """
+    Rebuilds a tokenizer from its to_dict output.
+    """
+    if data is None or data["type"] == WhitespaceTokenizer.name:
+        return WhitespaceTokenizer()
+    if data["type"] == BPETokenizer.name:
+        return BPETokenizer(data["merges"])
+    raise RuntimeError(f"Unknown tokenizer type '{data['type']}'")
+
+
+def train_tokenizer(kind, data_iter, num_merges):
+    """
+    :param kind: "whitespace" or "bpe"
+    :param data_iter: iterable of normalized sentences, only read for bpe
+    :param num_merges: number of bpe merges
+    :return: tokenizer
+    """
+    if kind == WhitespaceTokenizer.name:
+        return WhitespaceTokenizer()
+    if kind == BPETokenizer.name:
+        return BPETokenizer.train(data_iter, num_merges)
+    raise RuntimeError(f"Unknown tokenizer type '{kind}'")
 
 
 class Vocab:
-    def __init__(self, data_iter, lang):
+    def __init__(self, data_iter=(), lang=None, tokenizer=None):
         self.lang = lang
+        self.tokenizer = tokenizer or WhitespaceTokenizer()
         self.word2index = {}
-        self.index2word = {0: "SOS", 1: "EOS"}
+        self.index2word = list(SPECIAL_WORDS)
         self.word_freq = {}
-        self.num_words = 2
 
         for datum in data_iter:
-            sents = sent_tokenize(datum)
-            for sent in sents:
-                words = word_tokenize(sent)
-                for word in words:
-                    self.add_word(word)
+            for word in self.tokenizer.tokenize(datum):
+                self.add_word(word)
+
+    @property
+    def num_words(self):
+        return len(self.index2word)
 
     def add_word(self, word):
         if word not in self.word2index:
-            self.word2index[word] = self.num_words
-            self.index2word[self.num_words] = word
-            self.num_words += 1
+            self.word2index[word] = len(self.index2word)
+            self.index2word.append(word)
             self.word_freq[word] = 1
         else:
             self.word_freq[word] += 1
 
         return self.word2index[word]
+
+    def encode(self, sentence):
+        """
+        Converts a normalized sentence to token indices ending with EOS.
+        Tokens missing from the vocab map to UNK.
+
+        :param sentence: space separated words
+        :return: list of ints
+        """
+        return self.encode_batch([sentence])[0]
+
+    def encode_batch(self, sentences):
+        """
+        :param sentences: normalized sentences
+        :return: list of index lists, see encode
+        """
+        lookup = self.word2index.get
+        tokenize = self.tokenizer.tokenize
+        indices = []
+        for sentence in sentences:
+            row = [lookup(token, UNK_TOKEN) for token in tokenize(sentence)]
+            row.append(EOS_TOKEN)
+            indices.append(row)
+        return indices
+
+    def decode(self, indices):
+        return self.decode_batch([indices])[0]
+
+    def decode_batch(self, rows):
+        """
+        Converts index rows back to words, stopping each row at EOS,
+        dropping the other special tokens and joining subword tokens.
+
+        :param rows: list of index lists
+        :return: list of word lists
+        """
+        index2word = self.index2word
+        decoded = []
+        for row in rows:
+            tokens = []
+            for index in row:
+                if index == EOS_TOKEN:
+                    break
+                if index > UNK_TOKEN:
+                    tokens.append(index2word[index])
+            decoded.append(self.tokenizer.detokenize(tokens))
+        return decoded
+
+    def trim(self, min_freq=1, max_words=None):
+        """
+        Builds a smaller vocab from the most frequent words, shrinking the
+        embedding and output layers of models built on it. Dropped words
+        encode as UNK.
+
+        :param min_freq: drop words seen fewer times than this
+        :param max_words: keep at most this many words, specials included
+        :return: Vocab
+        """
+        words = sorted((word for word, freq in self.word_freq.items() if freq >= min_freq),
+                       key=lambda word: (-self.word_freq[word], self.word2index[word]))
+        if max_words is not None:
+            words = words[:max(max_words - len(SPECIAL_WORDS), 0)]
+
+        trimmed = Vocab(lang=self.lang, tokenizer=self.tokenizer)
+        for word in sorted(words, key=self.word2index.get):
+            trimmed.word2index[word] = len(trimmed.index2word)
+            trimmed.index2word.append(word)
+            trimmed.word_freq[word] = self.word_freq[word]
+        return trimmed
+
+    def to_dict(self):
+        """
+        Serializes vocab for storage in a model artifact.
+
+        :return: json dict
+        """
+        return {
+            "lang": self.lang,
+            "index2word": self.index2word,
+            "word_freq": self.word_freq,
+            "tokenizer": self.tokenizer.to_dict(),
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        """
+        Rebuilds vocab from the output of to_dict.
+
+        :param data: json dict
+        :return: Vocab
+        """
+        vocab = cls(lang=data["lang"],
+                    tokenizer=load_tokenizer(data.get("tokenizer")))
+        vocab.index2word = data["index2word"]
+        vocab.word_freq = data["word_freq"]
+        vocab.word2index = {word: index for index, word
+                            in enumerate(vocab.index2word)
+                            if index >= len(SPECIAL_WORDS)}
+        return vocab